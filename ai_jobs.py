@@ -0,0 +1,411 @@
+"""
+This file contains the worker pool that owns all the calls to the OpenAI API.
+
+Calls are queued as jobs and run by a bounded pool of background threads, so
+that the Streamlit script threads never block on the API. Pages get a job
+handle back, which they can poll from a fragment until the completion is ready.
+
+Jobs are served by priority, and in turn across sessions within a priority, as
+soon as the rate limiter lets them through.
+
+In the multi-process deployment, the pools of the workers share their
+completions and requests in flight, see shared_state.py.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any, Deque, Dict, Optional, Tuple
+
+from rate_limiter import RateLimiter
+from shared_state import SharedCompletions
+
+# Only needed for the annotations, the client is created by the pages.
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.types.chat.chat_completion import ChatCompletion
+
+
+class Priority(IntEnum):
+    """
+    Lower values are served first.
+    """
+
+    LIVE = 0
+    PREFETCH = 1
+
+
+def get_chat_completion_params(
+    model: str, prompt: str, json_schema: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    :param model: The model to use.
+    :param prompt: The prompt to send to the AI.
+    :param json_schema: The JSON schema to use for the response.
+    :return: The parameters of the chat completion request.
+    """
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+        "response_format": {"type": "json_schema", "json_schema": json_schema},
+        "temperature": 0,
+    }
+
+
+def create_chat_completion(
+    client: "OpenAI", model: str, prompt: str, json_schema: Dict[str, Any]
+) -> "ChatCompletion":
+    """
+    Send the prompt to the AI. This does not read the session state, so it can be
+    run outside of the Streamlit script thread.
+
+    :param client: The OpenAI client.
+    :param model: The model to use.
+    :param prompt: The prompt to send to the AI.
+    :param json_schema: The JSON schema to use for the response.
+    :return: The chat completion object from OpenAI.
+    """
+    return client.chat.completions.create(
+        **get_chat_completion_params(model, prompt, json_schema)
+    )
+
+
+class AIJob:
+    """
+    Handle on a chat completion computed by the worker pool.
+    """
+
+    def __init__(
+        self,
+        key: Tuple[str, str],
+        client: Optional["OpenAI"],
+        model: str,
+        prompt: str,
+        json_schema: Dict[str, Any],
+        tokens: int,
+        session_id: str,
+        priority: Priority,
+    ):
+        self.key = key
+        self.client = client
+        self.model = model
+        self.prompt = prompt
+        self.json_schema = json_schema
+        self.tokens = tokens
+        self.session_id = session_id
+        # Sessions interested in the result, which all need to cancel the job
+        # for it to be dropped.
+        self.sessions = {session_id}
+        self.priority = priority
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._done = threading.Event()
+        self._completion: Optional["ChatCompletion"] = None
+        self._error: Optional[BaseException] = None
+
+    @classmethod
+    def from_result(
+        cls,
+        key: Tuple[str, str],
+        model: str,
+        prompt: str,
+        json_schema: Dict[str, Any],
+        completion: Optional["ChatCompletion"] = None,
+        error: Optional[BaseException] = None,
+    ) -> "AIJob":
+        """
+        :return: A finished job, for completions obtained without the worker pool.
+        """
+        job = cls(key, None, model, prompt, json_schema, 0, "", Priority.LIVE)
+        job.started_at = job.submitted_at
+        job._finish(completion, error)
+        return job
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def exception(self) -> Optional[BaseException]:
+        """
+        :return: The error the job failed with, if it is done and failed.
+        """
+        return self._error
+
+    def result(self, timeout: Optional[float] = None) -> "ChatCompletion":
+        """
+        Wait for the job to finish.
+
+        :param timeout: The maximum number of seconds to wait, if any.
+        :return: The chat completion object from OpenAI.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("The AI job did not finish in time.")
+        if self._error is not None:
+            raise self._error
+        assert self._completion is not None
+        return self._completion
+
+    @property
+    def latency(self) -> Optional[float]:
+        """
+        :return: The number of seconds spent waiting on the API, once finished.
+        """
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def _finish(
+        self,
+        completion: Optional["ChatCompletion"] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        self.finished_at = time.monotonic()
+        self._completion = completion
+        self._error = error
+        self._done.set()
+
+
+class AIWorkerPool:
+    """
+    Bounded pool of threads running the chat completions of all sessions.
+
+    Identical requests are only sent once: submitting a request that is already
+    queued, running or recently completed returns the existing job.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        rate_limiter: RateLimiter,
+        cache_size: int = 256,
+        shared_completions: Optional[SharedCompletions] = None,
+    ):
+        # Queued jobs of each session, for each priority. Sessions are moved to
+        # the end once served, so that they take turns.
+        self._queued: Dict[Priority, OrderedDict[str, Deque[AIJob]]] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self._jobs: OrderedDict[Tuple[str, str], AIJob] = OrderedDict()
+        self._condition = threading.Condition()
+        self._rate_limiter = rate_limiter
+        self._cache_size = cache_size
+        self._shared_completions = shared_completions
+        self._running = 0
+        self._wait_times: Deque[float] = deque(maxlen=100)
+        for i in range(max_workers):
+            threading.Thread(
+                target=self._work, name=f"ai-worker-{i}", daemon=True
+            ).start()
+
+    def submit(
+        self,
+        client: "OpenAI",
+        model: str,
+        prompt: str,
+        json_schema: Dict[str, Any],
+        prompt_hash: str,
+        tokens: int,
+        session_id: str,
+        priority: Priority = Priority.LIVE,
+    ) -> AIJob:
+        """
+        Queue a chat completion.
+
+        :param client: The OpenAI client.
+        :param model: The model to use.
+        :param prompt: The prompt to send to the AI.
+        :param json_schema: The JSON schema to use for the response.
+        :param prompt_hash: The hash identifying the prompt and JSON schema.
+        :param tokens: The estimated number of tokens of the request and response.
+        :param session_id: The session the request comes from.
+        :param priority: The priority of the job.
+        :return: The job handle.
+        """
+        key = (model, prompt_hash)
+        with self._condition:
+            job = self._join(key, session_id, priority)
+            if job is not None:
+                return job
+
+        # Completions received by other workers are served without being queued.
+        completion = None
+        if self._shared_completions is not None:
+            completion = self._shared_completions.get(key)
+
+        with self._condition:
+            job = self._join(key, session_id, priority)
+            if job is not None:
+                return job
+            if completion is not None:
+                job = AIJob.from_result(
+                    key, model, prompt, json_schema, completion=completion
+                )
+                self._jobs[key] = job
+                self._evict()
+                return job
+
+            job = AIJob(
+                key, client, model, prompt, json_schema, tokens, session_id, priority
+            )
+            self._jobs[key] = job
+            self._enqueue(job)
+            return job
+
+    def cancel(self, job: AIJob, session_id: str) -> bool:
+        """
+        Withdraw the interest of a session in a job, and cancel the job if no
+        other session submitted it and it has not started yet.
+
+        :param job: The job to cancel.
+        :param session_id: The session cancelling the job.
+        :return: Whether the job was cancelled.
+        """
+        with self._condition:
+            job.sessions.discard(session_id)
+            if job.done() or job.started_at is not None or job.sessions:
+                return False
+            self._dequeue(job)
+            self._jobs.pop(job.key, None)
+        job._finish(error=CancelledError())
+        return True
+
+    def discard(self, job: AIJob) -> None:
+        """
+        Forget the completion of a finished job, e.g. a malformed one, so that its
+        request is sent again when next submitted.
+
+        :param job: The finished job.
+        """
+        with self._condition:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+        if self._shared_completions is not None:
+            self._shared_completions.delete(job.key)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: The number of queued jobs per priority, the number of running
+            jobs, and the mean number of seconds recent jobs spent queued.
+        """
+        with self._condition:
+            return {
+                "queued": {
+                    priority.name.lower(): sum(len(q) for q in sessions.values())
+                    for priority, sessions in self._queued.items()
+                },
+                "running": self._running,
+                "mean_wait_time": (
+                    sum(self._wait_times) / len(self._wait_times)
+                    if self._wait_times
+                    else 0.0
+                ),
+            }
+
+    def _join(
+        self, key: Tuple[str, str], session_id: str, priority: Priority
+    ) -> Optional[AIJob]:
+        """
+        Add a session to the job of a request, if there is one. Must be called
+        with the condition held.
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            return None
+        self._jobs.move_to_end(key)
+        job.sessions.add(session_id)
+        # A prefetched job becomes urgent once a participant waits on it.
+        if priority < job.priority and job.started_at is None:
+            self._dequeue(job)
+            job.priority = priority
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job: AIJob) -> None:
+        self._queued[job.priority].setdefault(job.session_id, deque()).append(job)
+        self._condition.notify()
+
+    def _dequeue(self, job: AIJob) -> None:
+        sessions = self._queued[job.priority]
+        sessions[job.session_id].remove(job)
+        if not sessions[job.session_id]:
+            del sessions[job.session_id]
+
+    def _next_job(self) -> AIJob:
+        """
+        Wait for the next job that the rate limiter lets through, and take it out
+        of the queue. Must be called with the condition held.
+        """
+        while True:
+            delay = None
+            # Models whose budget is exhausted by a job with a higher rank are
+            # not given to the jobs behind it.
+            blocked_models = set()
+            for priority in Priority:
+                for jobs in self._queued[priority].values():
+                    job = jobs[0]
+                    if job.model in blocked_models:
+                        continue
+                    job_delay = self._rate_limiter.try_acquire(job.model, job.tokens)
+                    if job_delay == 0:
+                        self._dequeue(job)
+                        if job.session_id in self._queued[priority]:
+                            self._queued[priority].move_to_end(job.session_id)
+                        return job
+                    blocked_models.add(job.model)
+                    delay = job_delay if delay is None else min(delay, job_delay)
+            self._condition.wait(timeout=delay)
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = self._next_job()
+                job.started_at = time.monotonic()
+                self._wait_times.append(job.started_at - job.submitted_at)
+                self._running += 1
+
+            try:
+                completion, sent = self._create_chat_completion(job)
+            except Exception as e:
+                with self._condition:
+                    self._running -= 1
+                    # Do not cache failures, so that the request can be retried.
+                    self._jobs.pop(job.key, None)
+                job._finish(error=e)
+                continue
+
+            if not sent:
+                # Another worker sent the request, give the budget back.
+                self._rate_limiter.settle(job.model, job.tokens, 0)
+            elif completion.usage is not None:
+                self._rate_limiter.settle(
+                    job.model, job.tokens, completion.usage.total_tokens
+                )
+            with self._condition:
+                self._running -= 1
+                self._evict()
+            job._finish(completion=completion)
+
+    def _create_chat_completion(self, job: AIJob) -> Tuple["ChatCompletion", bool]:
+        """
+        :return: The completion of the job, and whether its request was sent by
+            this pool rather than another worker.
+        """
+
+        def create() -> "ChatCompletion":
+            return create_chat_completion(
+                job.client, job.model, job.prompt, job.json_schema
+            )
+
+        if self._shared_completions is None:
+            return create(), True
+        return self._shared_completions.get_or_create(job.key, create)
+
+    def _evict(self) -> None:
+        finished = [key for key, job in self._jobs.items() if job.done()]
+        for key in finished[: max(0, len(self._jobs) - self._cache_size)]:
+            del self._jobs[key]
@@ -1,8 +1,14 @@
 import streamlit as st
-from openai import OpenAI
 
-from config import OPENAI_MODELS, Group
-from utils import get_group, page_setup, save_widget
+from config import (
+    AI_CASCADE_DRAFT_MODEL,
+    NUMBER_OF_CASES,
+    OPENAI_MODELS,
+    Backend,
+    Group,
+)
+from tokens import count_tokens
+from utils import get_case_description, get_group, page_setup, save_widget
 
 #######################################
 # SETUP
@@ -17,9 +23,6 @@ if "results" not in st.session_state:
 if "group" not in st.session_state["results"]:
     st.session_state["results"]["group"] = None
 
-if "client" not in st.session_state:
-    st.session_state["client"] = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
 
 #######################################
 # MAIN
@@ -52,12 +55,42 @@ model = st.radio(
     key="model",
 )
 
+st.radio(
+    label="Where should the AI answers come from?",
+    options=Backend,
+    format_func=(
+        lambda x: {
+            Backend.OPENAI: "OpenAI API",
+            Backend.REPLAY: "Recorded results, OpenAI API if not recorded",
+            Backend.REPLAY_STRICT: "Recorded results only",
+        }[x]
+    ),
+    key="backend",
+)
+
+st.checkbox(
+    f"Show a draft answer from `{AI_CASCADE_DRAFT_MODEL}` while the selected "
+    "model answers (cascade mode)",
+    key="cascade",
+)
+
 if st.button(
     "Start Experiment",
     disabled=(st.session_state["group"] is None or st.session_state["model"] is None),
 ):
     save_widget("group")
     save_widget("model")
+    save_widget("backend")
+    save_widget("cascade")
+
+    # Tokenize the cases once before the experiment starts, for the sessions
+    # sending AI requests.
+    if (
+        st.session_state["group"] is not Group.CONTROL
+        and st.session_state["backend"] is Backend.OPENAI
+    ):
+        for case_index in range(NUMBER_OF_CASES):
+            count_tokens(st.session_state["model"], get_case_description(case_index))
 
     st.switch_page("pages/01_domain_AI_expertise_questionnaire.py")
 
@@ -0,0 +1,233 @@
+"""
+This file contains the startup benchmark of the app.
+
+It measures what a participant waits for when the server is restarted between
+study sessions: the import time of the modules of the app, broken down by the
+modules they import, the time for the server to boot and answer its health
+check, and the time of the first render of each page.
+
+The app is run from a scratch copy of the repository with an empty results
+folder, so that the benchmark does not add events or sessions to the study.
+
+Usage:
+    python benchmark_startup.py
+    python benchmark_startup.py --repeat 5 --top 30
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, List, Tuple
+
+from config import Group
+
+# Modules whose import time is profiled, in the order the app imports them.
+PROFILED_MODULES = ["streamlit", "utils", "records", "responses", "transcripts"]
+
+PAGES = [
+    "app.py",
+    "pages/01_domain_AI_expertise_questionnaire.py",
+    "pages/02_case.py",
+    "pages/03_case_questionnaire.py",
+    "pages/04_condition_questionnaire.py",
+    "pages/05_semi-structured_interview.py",
+    "pages/06_admin_dashboard.py",
+]
+
+# Session state the pages after the setup page expect.
+SESSION_STATE = {
+    "results": {
+        "group": Group.HYPOTHESIS_DRIVEN,
+        "model": "gpt-4o-2024-08-06",
+    },
+}
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+SERVER_BOOT_TIMEOUT_SECONDS = 60
+
+
+def make_scratch_copy(folder_path: str) -> str:
+    """
+    :param folder_path: The folder to make the copy in.
+    :return: The path of a copy of the app, with an empty results folder.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    copy_path = os.path.join(folder_path, "app")
+    shutil.copytree(
+        root,
+        copy_path,
+        ignore=shutil.ignore_patterns("results", "__pycache__", ".git"),
+    )
+    os.makedirs(os.path.join(copy_path, "results"))
+    return copy_path
+
+
+def profile_imports(module: str, cwd: str) -> List[Tuple[int, int, int, str]]:
+    """
+    :param module: The module to import in a fresh interpreter.
+    :param cwd: The folder to import it from.
+    :return: The imported modules, as (self, cumulative, depth, name), with the
+        times in microseconds.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return [
+        (int(self_us), int(cumulative_us), len(indent) // 2, name)
+        for self_us, cumulative_us, indent, name in IMPORT_TIME_PATTERN.findall(
+            process.stderr
+        )
+    ]
+
+
+def print_import_profile(cwd: str, top: int) -> None:
+    for module in PROFILED_MODULES:
+        imports = profile_imports(module, cwd)
+        total = next(c for _, c, _, name in reversed(imports) if name == module)
+        print(f"\nimport {module}: {total / 1000:.0f} ms")
+        # The slowest third-party and app modules imported directly by the app.
+        direct = sorted(
+            (c, name) for _, c, depth, name in imports if depth <= 1 and name != module
+        )
+        for cumulative_us, name in reversed(direct[-top:]):
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+def _get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def time_server_boot(cwd: str) -> float:
+    """
+    :param cwd: The folder to run the app from.
+    :return: The number of seconds from launching the server to its health check
+        answering.
+    """
+    port = _get_free_port()
+    url = f"http://localhost:{port}/_stcore/health"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            "app.py",
+            "--server.headless=true",
+            f"--server.port={port}",
+            "--browser.gatherUsageStats=false",
+        ],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < SERVER_BOOT_TIMEOUT_SECONDS:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(
+            f"The server did not boot in {SERVER_BOOT_TIMEOUT_SECONDS}s."
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def time_first_renders(cwd: str) -> Dict[str, float]:
+    """
+    Render each page once in a fresh interpreter, as after a server restart.
+
+    :param cwd: The folder to run the app from.
+    :return: The number of seconds of the first render of each page.
+    """
+    script = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+import benchmark_startup
+
+page = sys.argv[1]
+at = AppTest.from_file(page, default_timeout=60)
+at.secrets["OPENAI_API_KEY"] = "benchmark"
+if page != "app.py":
+    for key, value in benchmark_startup.SESSION_STATE.items():
+        at.session_state[key] = value
+start = time.perf_counter()
+at.run()
+print(json.dumps([time.perf_counter() - start, [str(e.value) for e in at.exception]]))
+"""
+    renders = {}
+    for page in PAGES:
+        process = subprocess.run(
+            [sys.executable, "-c", script, page],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds, exceptions = json.loads(process.stdout.strip().splitlines()[-1])
+        if exceptions:
+            print(f"  {page} raised: {exceptions[0]}")
+        renders[page] = seconds
+    return renders
+
+
+def summarize(samples: List[float]) -> str:
+    if len(samples) == 1:
+        return f"{samples[0] * 1000:.0f} ms"
+    return (
+        f"{statistics.median(samples) * 1000:.0f} ms median, "
+        f"{min(samples) * 1000:.0f}-{max(samples) * 1000:.0f} ms"
+    )
+
+
+def repeat(measure: Callable[[], float], times: int) -> List[float]:
+    return [measure() for _ in range(times)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measure.")
+    parser.add_argument("--top", type=int, default=15, help="Imports listed.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        cwd = make_scratch_copy(folder_path)
+
+        print("# Import time")
+        print_import_profile(cwd, args.top)
+
+        print("\n# Server boot, until /_stcore/health answers")
+        print(summarize(repeat(lambda: time_server_boot(cwd), args.repeat)))
+
+        print("\n# First render of each page")
+        renders: Dict[str, List[float]] = {page: [] for page in PAGES}
+        for _ in range(args.repeat):
+            for page, seconds in time_first_renders(cwd).items():
+                renders[page].append(seconds)
+        for page, samples in renders.items():
+            print(f"{page}: {summarize(samples)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+This file contains the viewer of the case descriptions.
+
+A case description is split once into sections of at most
+`CASE_SECTION_MAX_WORDS` words, along paragraphs and then sentences. Only a
+window of `CASE_VIEWER_WINDOW_WORDS` words is rendered, so that the cost of a
+rerun does not grow with the length of the case. The spans of the case that the
+AI cited are found once per set of citations, and clicking a citation moves the
+window to its first span.
+"""
+
+import bisect
+import re
+import string
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import streamlit as st
+
+from config import CASE_SECTION_MAX_WORDS, CASE_VIEWER_WINDOW_WORDS
+from events import EventKind
+from utils import get_case_description, log_event
+
+
+@dataclass(frozen=True)
+class CaseSection:
+    """
+    A part of a case description, by its offsets in the description.
+    """
+
+    start: int
+    end: int
+    words: int
+
+
+# A highlighted span: its start and end offsets, and the number of the citation.
+Span = Tuple[int, int, int]
+
+
+def _split_sentences(start: int, text: str) -> List[Tuple[int, int, int]]:
+    return [
+        (start + m.start(), start + m.end(), len(m.group().split()))
+        for m in re.finditer(r".+?(?:[.!?](?=\s)|$)\s*", text, flags=re.DOTALL)
+    ]
+
+
+@st.cache_data
+def get_case_sections(case_index: int) -> List[CaseSection]:
+    """
+    :param case_index: The index of the case.
+    :return: The sections of the case description, in order. Paragraphs longer
+        than `CASE_SECTION_MAX_WORDS` words are split between sentences.
+    """
+    case_description = get_case_description(case_index)
+    sections = []
+    for paragraph in re.finditer(r"\S.*?(?=\n\s*\n|\s*$)", case_description, re.DOTALL):
+        start = end = paragraph.start()
+        words = 0
+        for _, sentence_end, sentence_words in _split_sentences(
+            paragraph.start(), paragraph.group()
+        ):
+            if words > 0 and words + sentence_words > CASE_SECTION_MAX_WORDS:
+                sections.append(CaseSection(start, end, words))
+                start, words = end, 0
+            end = sentence_end
+            words += sentence_words
+        sections.append(CaseSection(start, paragraph.end(), words))
+    return sections
+
+
+@st.cache_data
+def get_highlight_spans(case_index: int, citations: Tuple[str, ...]) -> List[Span]:
+    """
+    Find the spans of the case description quoted by the citations, ignoring
+    case and surrounding punctuation. Where citations overlap, the first one is
+    highlighted.
+
+    :param case_index: The index of the case.
+    :param citations: The citations of the AI message.
+    :return: The spans, sorted by start offset.
+    """
+    case_description = get_case_description(case_index)
+    spans: List[Span] = []
+    for number, citation in enumerate(citations, start=1):
+        quote = citation.strip(string.punctuation)
+        if not quote:
+            continue
+        for match in re.finditer(re.escape(quote), case_description, re.IGNORECASE):
+            i = bisect.bisect_left(spans, (match.start(),))
+            overlaps_previous = i > 0 and spans[i - 1][1] > match.start()
+            overlaps_next = i < len(spans) and spans[i][0] < match.end()
+            if not overlaps_previous and not overlaps_next:
+                spans.insert(i, (match.start(), match.end(), number))
+    return spans
+
+
+def highlight(case_description: str, start: int, end: int, spans: List[Span]) -> str:
+    """
+    :return: The markdown of a part of the case description, with the spans in
+        it highlighted and numbered after their citation.
+    """
+    parts = []
+    i = bisect.bisect_left(spans, (start,))
+    for span_start, span_end, number in spans[i:]:
+        if span_start >= end:
+            break
+        parts.append(case_description[start:span_start])
+        parts.append(
+            f":red-background[{case_description[span_start:span_end]} [{number}]]"
+        )
+        start = span_end
+    parts.append(case_description[start:end])
+    return "".join(parts)
+
+
+#######################################
+# WINDOW
+#######################################
+
+
+def _get_window_key(case_index: int) -> str:
+    return f"case_{case_index}_viewer_section"
+
+
+def get_window(case_index: int) -> Tuple[int, int]:
+    """
+    :return: The indices of the first and after last sections of the window.
+    """
+    sections = get_case_sections(case_index)
+    first = st.session_state.get(_get_window_key(case_index), 0)
+    last, words = first, 0
+    while last < len(sections) and (
+        last == first or words + sections[last].words <= CASE_VIEWER_WINDOW_WORDS
+    ):
+        words += sections[last].words
+        last += 1
+    return first, last
+
+
+def move_window(case_index: int, first: int) -> None:
+    sections = get_case_sections(case_index)
+    st.session_state[_get_window_key(case_index)] = max(
+        0, min(first, len(sections) - 1)
+    )
+
+
+def jump_to_citation(case_index: int, citations: Tuple[str, ...], number: int):
+    """
+    Move the window to the first span of a citation.
+    """
+    log_event(EventKind.CITATION_JUMP, citation=number)
+    for span_start, _, span_number in get_highlight_spans(case_index, citations):
+        if span_number == number:
+            sections = get_case_sections(case_index)
+            starts = [section.start for section in sections]
+            move_window(case_index, bisect.bisect_right(starts, span_start) - 1)
+            return
+
+
+def display_case_viewer(case_index: int, citations: Optional[List[str]]) -> None:
+    """
+    Display the window of the case description, with the citations highlighted.
+
+    :param case_index: The index of the case.
+    :param citations: The citations of the AI message shown, if any.
+    """
+    case_description = get_case_description(case_index)
+    sections = get_case_sections(case_index)
+    spans = get_highlight_spans(case_index, tuple(citations or ()))
+    first, last = get_window(case_index)
+
+    if first > 0:
+        st.button(
+            "Show the previous part of the case",
+            key=f"case_{case_index}_viewer_previous",
+            on_click=move_window,
+            args=(case_index, first - 1),
+        )
+    st.markdown(
+        highlight(
+            case_description, sections[first].start, sections[last - 1].end, spans
+        )
+    )
+    if last < len(sections):
+        st.button(
+            "Show the rest of the case",
+            key=f"case_{case_index}_viewer_next",
+            on_click=move_window,
+            args=(case_index, last),
+        )
+
+
+def display_citations(case_index: int, citations: List[str]) -> None:
+    """
+    Display the citations, each with a button showing it in the case.
+
+    :param case_index: The index of the case.
+    :param citations: The list of citations to display.
+    """
+    if len(citations) == 0:
+        st.caption("No citations found.")
+        return
+    st.caption("**Citations:**")
+    for number, citation in enumerate(citations, start=1):
+        button_col, citation_col = st.columns([0.1, 0.9])
+        with button_col:
+            st.button(
+                f"{number}",
+                key=f"citation_{number}",
+                help="Show in the case",
+                on_click=jump_to_citation,
+                args=(case_index, tuple(citations), number),
+            )
+        with citation_col:
+            st.caption(citation)
@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 
 NUMBER_OF_CASES = 4
@@ -9,3 +10,122 @@ class Group(Enum):
     CONTROL = "control"
     HYPOTHESIS_DRIVEN = "hypothesis_driven"
     RECOMMENDATIONS_DRIVEN = "recommendations_driven"
+
+
+class Backend(Enum):
+    OPENAI = "openai"
+    # Serve completions recorded in the results files, calling the OpenAI API
+    # when none was recorded.
+    REPLAY = "replay"
+    # Serve completions recorded in the results files, failing when none was
+    # recorded.
+    REPLAY_STRICT = "replay_strict"
+
+
+# Number of seconds the hypotheses must stay unchanged before the AI help is
+# prefetched in the background.
+AI_PREFETCH_DELAY_SECONDS = 2
+
+# Maximum number of requests sent to the OpenAI API at the same time, across all
+# sessions.
+AI_MAX_CONCURRENT_REQUESTS = 8
+
+# Requests and tokens per minute allowed for each model. These are the usage
+# tier 1 limits, and should be adjusted to those of the OpenAI organization.
+OPENAI_RATE_LIMITS = {
+    "gpt-3.5-turbo": {"rpm": 3_500, "tpm": 200_000},
+    "gpt-4-turbo": {"rpm": 500, "tpm": 30_000},
+    "gpt-4o-2024-08-06": {"rpm": 500, "tpm": 30_000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200_000},
+}
+
+# Expected number of output tokens of an AI response, used to budget the rate
+# limits. For the hypothesis-driven group, this is per hypothesis in the schema.
+AI_EXPECTED_OUTPUT_TOKENS = {
+    Group.HYPOTHESIS_DRIVEN: 400,
+    Group.RECOMMENDATIONS_DRIVEN: 600,
+}
+
+# Context window, in tokens, of each model.
+OPENAI_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16_385,
+    "gpt-4-turbo": 128_000,
+    "gpt-4o-2024-08-06": 128_000,
+    "gpt-4o-mini": 128_000,
+}
+
+# Price in USD per million input and output tokens of each model.
+OPENAI_PRICES = {
+    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
+    "gpt-4-turbo": {"input": 10.0, "output": 30.0},
+    "gpt-4o-2024-08-06": {"input": 2.5, "output": 10.0},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+}
+
+# Whether the case descriptions longer than `AI_CONTEXT_REDUCTION_MIN_WORDS`
+# words are reduced in the AI prompts to their first `AI_CONTEXT_SUMMARY_WORDS`
+# words and the sentences most relevant to the hypotheses, for a total of at
+# most `AI_CONTEXT_MAX_WORDS` words.
+AI_CONTEXT_REDUCTION = False
+AI_CONTEXT_REDUCTION_MIN_WORDS = 4_000
+AI_CONTEXT_SUMMARY_WORDS = 300
+AI_CONTEXT_MAX_WORDS = 2_000
+
+# Fast model whose answer is shown as a draft in cascade mode, while the model
+# selected for the experiment answers.
+AI_CASCADE_DRAFT_MODEL = "gpt-4o-mini"
+
+# Folder of the results of the sessions served from recorded completions, kept
+# out of the study results and of the study progress.
+REPLAY_RESULTS_FOLDER = "results/replay"
+
+# SQLite database holding the compressed AI transcripts of the results.
+TRANSCRIPTS_DB_PATH = "results/transcripts.db"
+
+# zstd compression level of the transcripts, and size in bytes of the dictionary
+# trained on them.
+TRANSCRIPTS_COMPRESSION_LEVEL = 19
+TRANSCRIPTS_DICTIONARY_SIZE = 32 * 1024
+
+# Number of transcripts stored before the first dictionary is trained.
+TRANSCRIPTS_MIN_TRAINING_SAMPLES = 200
+
+# SQLite database holding the interaction events of the participants.
+EVENTS_DB_PATH = "results/events.db"
+
+# Number of events buffered in memory, and number of events or seconds after
+# which the buffer is written to the database.
+EVENTS_BUFFER_SIZE = 100_000
+EVENTS_FLUSH_BATCH_SIZE = 500
+EVENTS_FLUSH_INTERVAL_SECONDS = 5
+
+# SQLite database holding the summaries of the completed sessions, and number of
+# seconds between updates of the admin dashboard.
+SESSIONS_DB_PATH = "results/sessions.db"
+DASHBOARD_REFRESH_SECONDS = 5
+
+# Maximum number of words of the sections a case description is split into, and
+# number of words of the sections rendered at once by the case viewer.
+CASE_SECTION_MAX_WORDS = 150
+CASE_VIEWER_WINDOW_WORDS = 1_000
+
+# Maximum width in pixels of the derivatives of the case images, the thumbnail
+# shown next to the case description and the full view shown on demand, their
+# JPEG quality, and the folder they are stored in.
+IMAGE_DERIVATIVE_WIDTHS = {"thumbnail": 480, "full": 1600}
+IMAGE_JPEG_QUALITY = 85
+IMAGE_DERIVATIVES_FOLDER = "data/derivatives"
+
+# SQLite database holding the state shared by the app workers of the
+# multi-process deployment, and number of workers, both set by launcher.py. When
+# unset, the app runs in a single process which keeps its state in memory.
+SHARED_STATE_DB_PATH = os.environ.get("SHARED_STATE_DB_PATH")
+APP_WORKERS = int(os.environ.get("APP_WORKERS", "1"))
+
+# Number of completions kept in the shared state database.
+AI_SHARED_CACHE_SIZE = 4096
+
+# Number of seconds after which a request claimed by a worker is assumed lost,
+# and number of seconds between checks for its completion by the other workers.
+AI_SINGLE_FLIGHT_TIMEOUT_SECONDS = 120
+AI_SINGLE_FLIGHT_POLL_SECONDS = 0.1
@@ -0,0 +1,282 @@
+"""
+This file contains the analysis of the differentials of the participants, the
+hypotheses they listed for each case.
+
+The hypotheses of all the sessions are folded to their canonical form and
+indexed once: each distinct hypothesis gets an id, and the index lists the
+differentials containing it. The metrics of all the differentials are then
+computed at once from the index arrays, rather than session by session:
+- size: the number of hypotheses,
+- ground_truth_hits: the number of hypotheses among the diagnoses of the case,
+  when they are given,
+- agreement: the mean share of the hypotheses that another participant of the
+  same group also listed for the case,
+- added_after_ai: the number of hypotheses added after the first AI help.
+
+Usage:
+    python differentials.py
+    python differentials.py --ground-truth data/ground_truth.json --output differentials.csv
+"""
+
+import argparse
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import NUMBER_OF_CASES, Group
+from hypotheses import canonicalize_hypothesis
+from records import AI_HELP_KEY_PATTERN
+from utils import get_hypotheses
+
+
+@dataclass
+class HypothesisIndex:
+    """
+    Inverted index of the canonical hypotheses of the differentials.
+    """
+
+    # The session, group and case of each differential, and whether AI help was
+    # received for it.
+    differentials: pd.DataFrame
+    # One row per hypothesis of a differential: the differential, the hypothesis
+    # id and whether it was added after the first AI help, by hypothesis id.
+    postings: pd.DataFrame
+    # The id of each canonical hypothesis.
+    ids: Dict[str, int]
+    # Start of the postings of each hypothesis id, and end of the last one.
+    offsets: np.ndarray
+
+    def lookup(self, hypothesis: str, case_index: int) -> pd.DataFrame:
+        """
+        :param hypothesis: A hypothesis, in any spelling.
+        :param case_index: The index of the case.
+        :return: The differentials of the case containing the hypothesis.
+        """
+        i = self.ids.get(canonicalize_hypothesis(hypothesis, case_index))
+        if i is None:
+            return self.differentials.iloc[:0]
+        rows = self.postings["differential"].to_numpy()[
+            self.offsets[i] : self.offsets[i + 1]
+        ]
+        differentials = self.differentials.iloc[rows]
+        return differentials[differentials["case"] == case_index]
+
+
+def build_index(folder_path: str = "results") -> HypothesisIndex:
+    """
+    Index the final hypotheses of each case of the results files of a folder.
+
+    :param folder_path: The folder containing the results files.
+    :return: The index of the hypotheses.
+    """
+    ids: Dict[str, int] = {}
+    # Spellings are canonicalized once across the sessions.
+    spelling_ids: Dict[tuple, int] = {}
+    differentials: Dict[str, list] = {"session": [], "group": [], "case": []}
+    ai_help: List[bool] = []
+    posting_differentials: List[int] = []
+    posting_hypotheses: List[int] = []
+    posting_after_ai: List[bool] = []
+
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(folder_path, filename), "r") as json_file:
+            results = json.load(json_file)
+        if "group" not in results:
+            continue
+        # Groups are saved as e.g. "Group.HYPOTHESIS_DRIVEN".
+        group = Group[results["group"].split(".")[-1]].value
+
+        # The hypotheses listed when the first AI help of each case was asked.
+        first_ai_help: Dict[int, tuple] = {}
+        for key, entry in results.items():
+            match = AI_HELP_KEY_PATTERN.fullmatch(key)
+            if match is None:
+                continue
+            case_index = int(match.group(1))
+            reveal_time = str(entry.get("reveal_time"))
+            if (
+                case_index not in first_ai_help
+                or reveal_time < first_ai_help[case_index][0]
+            ):
+                first_ai_help[case_index] = (reveal_time, entry["hypotheses"])
+
+        for i in range(NUMBER_OF_CASES):
+            hypotheses = results.get(f"case_{i}_hypotheses")
+            if hypotheses is None:
+                continue
+            # The final hypotheses used to be saved as the table given by
+            # streamlit.
+            if isinstance(hypotheses, dict):
+                hypotheses = get_hypotheses(hypotheses)[0]
+
+            hypothesis_ids = []
+            for spellings in [hypotheses, first_ai_help.get(i, (None, []))[1]]:
+                for spelling in spellings:
+                    if (spelling, i) not in spelling_ids:
+                        spelling_ids[spelling, i] = ids.setdefault(
+                            canonicalize_hypothesis(spelling, i), len(ids)
+                        )
+                hypothesis_ids.append(
+                    list(dict.fromkeys(spelling_ids[s, i] for s in spellings))
+                )
+            final_ids, before_ai_ids = hypothesis_ids
+
+            differential = len(ai_help)
+            differentials["session"].append(filename.removesuffix(".json"))
+            differentials["group"].append(group)
+            differentials["case"].append(i)
+            ai_help.append(i in first_ai_help)
+            before_ai = set(before_ai_ids)
+            for hypothesis_id in final_ids:
+                posting_differentials.append(differential)
+                posting_hypotheses.append(hypothesis_id)
+                posting_after_ai.append(
+                    i in first_ai_help and hypothesis_id not in before_ai
+                )
+
+    postings = pd.DataFrame(
+        {
+            "differential": np.array(posting_differentials, dtype=np.int64),
+            "hypothesis": np.array(posting_hypotheses, dtype=np.int64),
+            "after_ai": np.array(posting_after_ai, dtype=bool),
+        }
+    )
+    postings = postings.sort_values("hypothesis", kind="stable", ignore_index=True)
+    return HypothesisIndex(
+        differentials=pd.DataFrame(differentials).assign(ai_help=ai_help),
+        postings=postings,
+        ids=ids,
+        offsets=np.searchsorted(
+            postings["hypothesis"].to_numpy(), np.arange(len(ids) + 1)
+        ),
+    )
+
+
+def load_ground_truth(path: str) -> Dict[int, List[str]]:
+    """
+    :param path: A JSON file mapping case indices to the diagnoses of the case.
+    :return: The diagnoses of each case.
+    """
+    with open(path, "r") as json_file:
+        return {int(i): diagnoses for i, diagnoses in json.load(json_file).items()}
+
+
+def compute_metrics(
+    index: HypothesisIndex, ground_truth: Optional[Dict[int, List[str]]] = None
+) -> pd.DataFrame:
+    """
+    :param index: The index of the hypotheses.
+    :param ground_truth: The diagnoses of each case, if known.
+    :return: The differentials, with their metrics.
+    """
+    differentials = index.differentials
+    postings = index.postings
+    n = len(differentials)
+    posting_differentials = postings["differential"].to_numpy()
+    posting_hypotheses = postings["hypothesis"].to_numpy()
+
+    size = np.bincount(posting_differentials, minlength=n)
+    metrics = differentials.assign(size=size)
+
+    if ground_truth is not None:
+        is_diagnosis = np.zeros((NUMBER_OF_CASES, len(index.ids)), dtype=bool)
+        diagnoses = np.zeros(NUMBER_OF_CASES)
+        for i, case_diagnoses in ground_truth.items():
+            canonical = {canonicalize_hypothesis(d, i) for d in case_diagnoses}
+            diagnoses[i] = len(canonical)
+            for diagnosis in canonical & index.ids.keys():
+                is_diagnosis[i, index.ids[diagnosis]] = True
+        posting_cases = differentials["case"].to_numpy()[posting_differentials]
+        hits = np.bincount(
+            posting_differentials,
+            weights=is_diagnosis[posting_cases, posting_hypotheses],
+            minlength=n,
+        )
+        # Cases without known diagnoses have neither hits nor recall.
+        case_diagnoses = diagnoses[differentials["case"].to_numpy()]
+        case_diagnoses[case_diagnoses == 0] = np.nan
+        metrics["ground_truth_hits"] = np.where(case_diagnoses > 0, hits, np.nan)
+        metrics["ground_truth_recall"] = hits / case_diagnoses
+
+    # Number of participants of each group and case, and number of them listing
+    # each hypothesis.
+    cohorts = differentials.groupby(["group", "case"]).ngroup().to_numpy()
+    cohort_sizes = np.bincount(cohorts)
+    posting_cohorts = cohorts[posting_differentials]
+    _, inverse, counts = np.unique(
+        posting_cohorts * len(index.ids) + posting_hypotheses,
+        return_inverse=True,
+        return_counts=True,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shared = (counts[inverse] - 1) / (cohort_sizes[posting_cohorts] - 1)
+        metrics["agreement"] = (
+            np.bincount(posting_differentials, weights=shared, minlength=n) / size
+        )
+
+    added_after_ai = np.bincount(
+        posting_differentials, weights=postings["after_ai"].to_numpy(), minlength=n
+    )
+    metrics["added_after_ai"] = np.where(
+        differentials["ai_help"], added_after_ai, np.nan
+    )
+    return metrics
+
+
+def summarize(metrics: pd.DataFrame) -> pd.DataFrame:
+    """
+    :param metrics: The differentials, with their metrics.
+    :return: The mean metrics per group and case.
+    """
+    columns = [
+        c
+        for c in [
+            "size",
+            "ground_truth_hits",
+            "ground_truth_recall",
+            "agreement",
+            "added_after_ai",
+        ]
+        if c in metrics
+    ]
+    summary = metrics.groupby(["group", "case"])[columns].mean()
+    summary.insert(0, "differentials", metrics.groupby(["group", "case"]).size())
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--results", default="results", help="Results folder.")
+    parser.add_argument(
+        "--ground-truth",
+        default="data/ground_truth.json",
+        help="JSON file of the diagnoses of each case, used if it exists.",
+    )
+    parser.add_argument(
+        "--output", help="CSV file to save the per-differential table to."
+    )
+    args = parser.parse_args()
+
+    index = build_index(args.results)
+    ground_truth = None
+    if os.path.exists(args.ground_truth):
+        ground_truth = load_ground_truth(args.ground_truth)
+    metrics = compute_metrics(index, ground_truth)
+    if args.output:
+        metrics.to_csv(args.output, index=False)
+    if len(metrics) == 0:
+        print("No recorded hypotheses to analyze.")
+        return
+    print(f"{len(index.ids)} distinct hypotheses in {len(metrics)} differentials.")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(summarize(metrics))
+
+
+if __name__ == "__main__":
+    main()
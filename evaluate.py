@@ -0,0 +1,266 @@
+"""
+This file contains the offline evaluation of the OpenAI models on the cases.
+
+Every case x recorded hypothesis set x model x group is sent concurrently, to
+the OpenAI API or to the completions recorded in the results (replay). Responses
+are validated against the response models and their citations checked against
+the case description, then latency, tokens, cost and failure rates are reported
+per model and group.
+
+Usage:
+    python evaluate.py
+    python evaluate.py --models gpt-4o-mini gpt-4o-2024-08-06 --concurrency 4
+    python evaluate.py --backend replay --output evaluation.csv
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+import pandas as pd
+import toml
+from openai import AsyncOpenAI
+
+from ai_jobs import get_chat_completion_params
+from config import NUMBER_OF_CASES, OPENAI_MODELS, OPENAI_PRICES, Group
+from hypotheses import canonicalize_hypotheses
+from records import AI_HELP_KEY_PATTERN
+from replay import ReplayStore
+from retrieval import get_prompt_case_description
+from utils import (
+    evaluate_message,
+    get_ai_prompt,
+    get_case_description,
+    get_hypotheses,
+    get_json_schema,
+    get_prompt_hash,
+)
+
+AI_GROUPS = [Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN]
+
+
+def load_hypothesis_sets(folder_path: str) -> Dict[int, Set[Tuple[str, ...]]]:
+    """
+    Collect the distinct sets of canonical hypotheses recorded for each case,
+    both final and at the time of each AI call.
+
+    :param folder_path: The folder containing the results files.
+    :return: The hypothesis sets of each case.
+    """
+    hypothesis_sets: Dict[int, Set[Tuple[str, ...]]] = {
+        i: set() for i in range(NUMBER_OF_CASES)
+    }
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(folder_path, filename), "r") as json_file:
+            results = json.load(json_file)
+
+        recorded: List[Tuple[int, List[str]]] = []
+        for i in range(NUMBER_OF_CASES):
+            final_hypotheses = results.get(f"case_{i}_hypotheses", [])
+            # The final hypotheses are saved as the table given by streamlit.
+            if isinstance(final_hypotheses, dict):
+                final_hypotheses = get_hypotheses(final_hypotheses)[0]
+            recorded.append((i, final_hypotheses))
+        for key, entry in results.items():
+            match = AI_HELP_KEY_PATTERN.fullmatch(key)
+            if match is not None:
+                recorded.append((int(match.group(1)), entry["hypotheses"]))
+
+        for i, hypotheses in recorded:
+            canonical_hypotheses, _ = canonicalize_hypotheses(hypotheses, i)
+            if len(canonical_hypotheses) != 0:
+                hypothesis_sets[i].add(tuple(canonical_hypotheses))
+    return hypothesis_sets
+
+
+async def run_request(
+    client: AsyncOpenAI | None,
+    replay_store: ReplayStore | None,
+    semaphore: asyncio.Semaphore,
+    case_index: int,
+    group: Group,
+    model: str,
+    hypotheses: List[str],
+) -> Dict[str, Any]:
+    """
+    Send one request and evaluate the response.
+
+    :return: A row of the evaluation table.
+    """
+    case_description = get_case_description(case_index)
+    # The prompt of the app, with the case reduced if it is.
+    prompt_case_description, _ = get_prompt_case_description(case_index, hypotheses)
+    prompt = get_ai_prompt(group, prompt_case_description, hypotheses)
+    json_schema = get_json_schema(group, hypotheses)
+
+    row = {
+        "case": case_index,
+        "group": group.value,
+        "model": model,
+        "hypotheses": len(hypotheses),
+        "error": None,
+        "latency": None,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "cost": None,
+        # Filled in by `evaluate_message` when the request succeeds.
+        "schema_valid": None,
+        "citations": None,
+        "grounded_citations": None,
+        "lead_diagnosis_valid": None,
+    }
+    raw_message = None
+    async with semaphore:
+        start = time.perf_counter()
+        if replay_store is not None:
+            raw_message = replay_store.get(
+                get_prompt_hash(prompt, json_schema), model, other_models=False
+            )
+            if raw_message is None:
+                row["error"] = "not recorded"
+        else:
+            assert client is not None
+            try:
+                completion = await client.chat.completions.create(
+                    **get_chat_completion_params(model, prompt, json_schema)
+                )
+            except Exception as e:
+                row["error"] = type(e).__name__
+            else:
+                raw_message = completion.choices[0].message.content
+                if completion.usage is not None:
+                    row["prompt_tokens"] = completion.usage.prompt_tokens
+                    row["completion_tokens"] = completion.usage.completion_tokens
+                    row["cost"] = (
+                        completion.usage.prompt_tokens * OPENAI_PRICES[model]["input"]
+                        + completion.usage.completion_tokens
+                        * OPENAI_PRICES[model]["output"]
+                    ) / 1_000_000
+        row["latency"] = time.perf_counter() - start
+
+    if row["error"] is None:
+        row.update(evaluate_message(raw_message, group, case_description, hypotheses))
+    return row
+
+
+async def run_evaluation(
+    hypothesis_sets: Dict[int, Set[Tuple[str, ...]]],
+    models: List[str],
+    groups: List[Group],
+    backend: str,
+    concurrency: int,
+    results_path: str,
+) -> pd.DataFrame:
+    """
+    :return: The evaluation table, with one row per request.
+    """
+    client = None
+    replay_store = None
+    if backend == "replay":
+        replay_store = ReplayStore.from_results(results_path)
+    else:
+        api_key = (
+            os.environ.get("OPENAI_API_KEY")
+            or toml.load(".streamlit/secrets.toml")["OPENAI_API_KEY"]
+        )
+        client = AsyncOpenAI(api_key=api_key)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    rows = await asyncio.gather(
+        *[
+            run_request(
+                client, replay_store, semaphore, case_index, group, model, list(h)
+            )
+            for case_index, sets in hypothesis_sets.items()
+            for h in sorted(sets)
+            for model in models
+            for group in groups
+        ]
+    )
+    return pd.DataFrame(rows)
+
+
+def summarize(evaluation: pd.DataFrame) -> pd.DataFrame:
+    """
+    :param evaluation: The evaluation table, with one row per request.
+    :return: The latency percentiles, tokens, cost and failure rates per model and
+        group.
+    """
+    # Columns of failed requests hold None, which stays numeric as NaN.
+    numeric_columns = [
+        "latency",
+        "prompt_tokens",
+        "completion_tokens",
+        "cost",
+        "citations",
+        "grounded_citations",
+        "lead_diagnosis_valid",
+    ]
+    evaluation = evaluation.astype({c: float for c in numeric_columns}).assign(
+        failed=evaluation["error"].notna(),
+        schema_failure=evaluation["schema_valid"].eq(False),
+    )
+    by_model = evaluation.groupby(["model", "group"])
+    summary = by_model.agg(
+        requests=("case", "size"),
+        error_rate=("failed", "mean"),
+        schema_failure_rate=("schema_failure", "mean"),
+        prompt_tokens=("prompt_tokens", "mean"),
+        completion_tokens=("completion_tokens", "mean"),
+        total_cost=("cost", "sum"),
+        citations=("citations", "sum"),
+        grounded_citations=("grounded_citations", "sum"),
+        lead_diagnosis_valid_rate=("lead_diagnosis_valid", "mean"),
+    )
+    for percentile in [50, 90, 99]:
+        summary[f"latency_p{percentile}"] = by_model["latency"].quantile(
+            percentile / 100
+        )
+    summary["grounded_rate"] = summary["grounded_citations"] / summary["citations"]
+    return summary.sort_values("latency_p50")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--results", default="results", help="Results folder.")
+    parser.add_argument("--models", nargs="+", default=OPENAI_MODELS)
+    parser.add_argument(
+        "--groups",
+        nargs="+",
+        default=[g.value for g in AI_GROUPS],
+        choices=[g.value for g in AI_GROUPS],
+    )
+    parser.add_argument("--backend", choices=["openai", "replay"], default="openai")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Maximum concurrent requests."
+    )
+    parser.add_argument("--output", help="CSV file to save the per-request table to.")
+    args = parser.parse_args()
+
+    hypothesis_sets = load_hypothesis_sets(args.results)
+    evaluation = asyncio.run(
+        run_evaluation(
+            hypothesis_sets,
+            args.models,
+            [Group(g) for g in args.groups],
+            args.backend,
+            args.concurrency,
+            args.results,
+        )
+    )
+    if args.output:
+        evaluation.to_csv(args.output, index=False)
+    if len(evaluation) == 0:
+        print("No recorded hypotheses to evaluate.")
+        return
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(summarize(evaluation))
+
+
+if __name__ == "__main__":
+    main()
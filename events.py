@@ -0,0 +1,184 @@
+"""
+This file contains the interaction event log of the participants.
+
+Events are timestamped with the monotonic clock in nanoseconds, so that the
+durations computed from them are precise and do not break across midnight or
+clock changes, along with the wall clock time. They are buffered in an in-memory
+ring and written to a SQLite database in batches by a background thread, so that
+recording an event does not slow the reruns down.
+"""
+
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Deque, Optional, Tuple
+
+from config import (
+    EVENTS_BUFFER_SIZE,
+    EVENTS_DB_PATH,
+    EVENTS_FLUSH_BATCH_SIZE,
+    EVENTS_FLUSH_INTERVAL_SECONDS,
+)
+
+# pandas is only used by the analysis, not by the app recording the events.
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class EventKind(Enum):
+    PAGE_LOAD = "page_load"
+    CASE_START = "case_start"
+    HYPOTHESES_EDIT = "hypotheses_edit"
+    AI_REQUEST = "ai_request"
+    AI_RESPONSE = "ai_response"
+    AI_REVEAL = "ai_reveal"
+    CITATION_VIEW = "citation_view"
+    CITATION_JUMP = "citation_jump"
+    CASE_END = "case_end"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    session TEXT NOT NULL,
+    monotonic_ns INTEGER NOT NULL,
+    time_ns INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    case_index INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (session, case_index);
+"""
+
+# An event: the session, monotonic and wall clock times, kind, case index and
+# JSON data.
+Event = Tuple[str, int, int, str, Optional[int], Optional[str]]
+
+
+class EventLog:
+    """
+    Process-wide buffer of events, flushed to the database in batches.
+    """
+
+    def __init__(self, path: str = EVENTS_DB_PATH):
+        self.path = path
+        # Events are only dropped if the database cannot be written to for long
+        # enough to fill the ring.
+        self._buffer: Deque[Event] = deque(maxlen=EVENTS_BUFFER_SIZE)
+        self._lock = threading.Lock()
+        self._flushing = threading.Event()
+        with sqlite3.connect(self.path) as connection:
+            connection.executescript(SCHEMA)
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self.flush)
+
+    def record(
+        self,
+        session: str,
+        kind: EventKind,
+        case_index: Optional[int] = None,
+        **data: Any,
+    ) -> None:
+        """
+        Record an event. This only appends to the buffer, the event is written
+        with the next batch.
+
+        :param session: The session the event happened in.
+        :param kind: The kind of event.
+        :param case_index: The index of the case, if any.
+        :param data: Details of the event, saved as JSON.
+        """
+        event = (
+            session,
+            time.monotonic_ns(),
+            time.time_ns(),
+            kind.value,
+            case_index,
+            json.dumps(data, default=str) if data else None,
+        )
+        with self._lock:
+            self._buffer.append(event)
+            if len(self._buffer) >= EVENTS_FLUSH_BATCH_SIZE:
+                self._flushing.set()
+
+    def flush(self) -> None:
+        """
+        Write the buffered events to the database.
+        """
+        with self._lock:
+            events = list(self._buffer)
+            self._buffer.clear()
+        if len(events) == 0:
+            return
+        try:
+            with sqlite3.connect(self.path, timeout=30) as connection:
+                connection.executemany(
+                    "INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", events
+                )
+        except sqlite3.Error:
+            # Put the events back in front of the ones recorded since.
+            with self._lock:
+                self._buffer.extendleft(reversed(events))
+            raise
+
+    def _flush_periodically(self) -> None:
+        while True:
+            self._flushing.wait(timeout=EVENTS_FLUSH_INTERVAL_SECONDS)
+            self._flushing.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass
+
+
+def load_events(path: str = EVENTS_DB_PATH) -> "pd.DataFrame":
+    """
+    :param path: The path of the events database.
+    :return: The events, one per row, in the order they happened in each session.
+    """
+    import pandas as pd
+
+    with sqlite3.connect(path) as connection:
+        events = pd.read_sql(
+            "SELECT * FROM events ORDER BY session, monotonic_ns", connection
+        )
+    events["case_index"] = events["case_index"].astype("Int64")
+    events["time"] = pd.to_datetime(events["time_ns"], unit="ns")
+    return events
+
+
+def get_case_durations(events: "pd.DataFrame") -> "pd.DataFrame":
+    """
+    Compute the time spent on each case from the events.
+
+    :param events: The events, as given by `load_events`.
+    :return: For each session and case, the number of seconds from the start of
+        the case to its end and to the first AI help revealed, and the number of
+        hypotheses edits and AI requests.
+    """
+    import pandas as pd
+
+    events = events[events["case_index"].notna()]
+    by_case = events.groupby(["session", "case_index", "kind"])["monotonic_ns"]
+    first = by_case.min().unstack("kind")
+    counts = by_case.size().unstack("kind", fill_value=0)
+
+    durations = pd.DataFrame(index=first.index)
+    start = first.get(EventKind.CASE_START.value)
+    for column, kind in [
+        ("duration", EventKind.CASE_END),
+        ("time_to_ai_reveal", EventKind.AI_REVEAL),
+    ]:
+        end = first.get(kind.value)
+        durations[column] = (
+            (end - start) / 1e9 if start is not None and end is not None else None
+        )
+    for column, kind in [
+        ("hypotheses_edits", EventKind.HYPOTHESES_EDIT),
+        ("ai_requests", EventKind.AI_REQUEST),
+    ]:
+        durations[column] = counts.get(kind.value, 0)
+    return durations.reset_index()
@@ -0,0 +1,83 @@
+"""
+This file contains the canonicalization of hypotheses.
+
+Hypotheses are folded to a canonical form before building the AI prompts and
+schemas, so that e.g. "Pulmonary embolism", "pulmonary embolism " and "PE" lead
+to the same request. The original spellings are kept for display and results.
+
+Abbreviations and synonyms are read from `data/synonyms.json`, and from
+`data/case_{case_index}_synonyms.json` for case-specific ones. Both map a
+canonical hypothesis to the list of its other spellings.
+"""
+
+import json
+import os
+import string
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# Apostrophes are removed ("Crohn's" -> "crohns"), other punctuation becomes a
+# space ("Guillain-Barré" -> "guillain barré").
+_PUNCTUATION_TABLE = str.maketrans(
+    {c: "" if c == "'" else " " for c in string.punctuation}
+)
+
+
+def normalize_hypothesis(hypothesis: str) -> str:
+    """
+    Fold the case, punctuation and whitespace of a hypothesis.
+
+    :param hypothesis: The hypothesis as entered by the user.
+    :return: The normalized hypothesis.
+    """
+    hypothesis = unicodedata.normalize("NFKC", hypothesis).casefold()
+    hypothesis = hypothesis.replace("’", "'").translate(_PUNCTUATION_TABLE)
+    return " ".join(hypothesis.split())
+
+
+@lru_cache(maxsize=None)
+def get_synonyms(case_index: int) -> Dict[str, str]:
+    """
+    :param case_index: The index of the case.
+    :return: A dictionary mapping normalized spellings to canonical hypotheses.
+    """
+    synonyms = {}
+    for file_path in ["data/synonyms.json", f"data/case_{case_index}_synonyms.json"]:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "r") as json_file:
+            for canonical, spellings in json.load(json_file).items():
+                canonical = normalize_hypothesis(canonical)
+                for spelling in spellings:
+                    synonyms[normalize_hypothesis(spelling)] = canonical
+    return synonyms
+
+
+def canonicalize_hypothesis(hypothesis: str, case_index: int) -> str:
+    """
+    :param hypothesis: The hypothesis as entered by the user.
+    :param case_index: The index of the case.
+    :return: The canonical hypothesis.
+    """
+    normalized = normalize_hypothesis(hypothesis)
+    return get_synonyms(case_index).get(normalized, normalized)
+
+
+def canonicalize_hypotheses(
+    hypotheses: List[str], case_index: int
+) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Canonicalize, deduplicate and sort hypotheses.
+
+    :param hypotheses: The hypotheses as entered by the user.
+    :param case_index: The index of the case.
+    :return: A tuple containing the sorted canonical hypotheses, and a dictionary
+        mapping each of them to the first original spelling entered.
+    """
+    original_spellings: Dict[str, str] = {}
+    for hypothesis in hypotheses:
+        canonical = canonicalize_hypothesis(hypothesis, case_index)
+        if canonical and canonical not in original_spellings:
+            original_spellings[canonical] = hypothesis.strip()
+    return sorted(original_spellings), original_spellings
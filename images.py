@@ -0,0 +1,127 @@
+"""
+This file contains the derivatives of the case images shown on the case page.
+
+Case images can be large scans. Instead of handing them to `st.image` as is,
+which reads, decodes and hashes the whole file on every rerun, two resized and
+optimized JPEG derivatives are made once: a thumbnail shown next to the case
+description, and a full view shown on demand. Derivatives are stored next to the
+data, named after the hash of the image content, so that they are only made
+again when the image changes, and kept in memory once loaded. Streamlit serves
+the same bytes under the same URL, so browsers cache them across reruns.
+
+Usage:
+    python images.py  # Make the derivatives of the case images.
+"""
+
+import argparse
+import glob
+import hashlib
+import io
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from config import (
+    IMAGE_DERIVATIVE_WIDTHS,
+    IMAGE_DERIVATIVES_FOLDER,
+    IMAGE_JPEG_QUALITY,
+)
+
+
+@dataclass(frozen=True)
+class ImageDerivative:
+    data: bytes
+    width: int
+    height: int
+    # Hash of the content of the original image.
+    source_hash: str
+
+
+def get_case_image_path(case_index: int) -> Optional[str]:
+    """
+    :param case_index: The index of the case.
+    :return: The path of the image of the case, if there is one.
+    """
+    path = f"data/case_{case_index}.jpg"
+    return path if os.path.exists(path) else None
+
+
+def make_derivative(data: bytes, width: int) -> bytes:
+    """
+    :param data: The content of the original image.
+    :param width: The maximum width of the derivative, in pixels.
+    :return: The derivative, as a progressive JPEG.
+    """
+    # Imported here, Pillow is only needed when the derivatives are made.
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # Apply the EXIF orientation, which is not kept in the derivative.
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((width, width * 10), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(
+            output,
+            "JPEG",
+            quality=IMAGE_JPEG_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+    return output.getvalue()
+
+
+@lru_cache(maxsize=None)
+def _get_derivative(path: str, modified_ns: int, kind: str) -> ImageDerivative:
+    from PIL import Image
+
+    with open(path, "rb") as image_file:
+        data = image_file.read()
+    source_hash = hashlib.sha256(data).hexdigest()[:16]
+
+    derivative_path = os.path.join(
+        IMAGE_DERIVATIVES_FOLDER, f"{source_hash}_{kind}.jpg"
+    )
+    if os.path.exists(derivative_path):
+        with open(derivative_path, "rb") as derivative_file:
+            derivative = derivative_file.read()
+    else:
+        derivative = make_derivative(data, IMAGE_DERIVATIVE_WIDTHS[kind])
+        os.makedirs(IMAGE_DERIVATIVES_FOLDER, exist_ok=True)
+        # Written under a temporary name, so that concurrent sessions and app
+        # workers never read a partial file.
+        temporary_path = f"{derivative_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as derivative_file:
+            derivative_file.write(derivative)
+        os.replace(temporary_path, derivative_path)
+
+    with Image.open(io.BytesIO(derivative)) as image:
+        width, height = image.size
+    return ImageDerivative(derivative, width, height, source_hash)
+
+
+def get_derivative(path: str, kind: str) -> ImageDerivative:
+    """
+    :param path: The path of the original image.
+    :param kind: "thumbnail" or "full", see `IMAGE_DERIVATIVE_WIDTHS`.
+    :return: The derivative of the image, made on first use.
+    """
+    return _get_derivative(path, os.stat(path).st_mtime_ns, kind)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.parse_args()
+
+    for path in sorted(glob.glob("data/case_*.jpg")):
+        for kind in IMAGE_DERIVATIVE_WIDTHS:
+            derivative = get_derivative(path, kind)
+            print(
+                f"{path} {kind}: {derivative.width}x{derivative.height}, "
+                f"{len(derivative.data) / 1024:.0f} KiB "
+                f"(original {os.path.getsize(path) / 1024:.0f} KiB)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+This file contains the launcher of the multi-process deployment of the app.
+
+A single Streamlit server runs the scripts of all the sessions in one process,
+so they take turns under the GIL. The launcher starts several app workers, each
+a Streamlit server on its own port, behind a reverse proxy on the public port.
+The session state lives in the worker a browser is connected to, so each
+browser is assigned a worker on its first request and kept on it with a cookie.
+The workers share the AI completions, rate limits and requests in flight through
+a SQLite database, see shared_state.py. Each worker sends its share of the
+`AI_MAX_CONCURRENT_REQUESTS` requests at a time, so there are at most that many
+workers.
+
+Usage:
+    python launcher.py                       # One worker per core.
+    python launcher.py --workers 4 --port 8501
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
+
+import tornado.httpclient
+import tornado.web
+import tornado.websocket
+from tornado.httputil import HTTPHeaders
+
+from config import AI_MAX_CONCURRENT_REQUESTS
+
+# Cookie naming the worker of a browser.
+WORKER_COOKIE = "app_worker"
+
+# Headers that only apply to one connection, and are not forwarded.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Headers of the WebSocket handshake, which the proxy makes again.
+WEBSOCKET_HEADERS = {
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+}
+
+WORKER_BOOT_TIMEOUT_SECONDS = 60
+
+# Largest WebSocket message forwarded, the default of Streamlit.
+MAX_MESSAGE_SIZE = 200 * 1024 * 1024
+
+
+@dataclass
+class Worker:
+    port: int
+    process: Optional[subprocess.Popen] = None
+    # Number of browsers connected to the worker.
+    connections: int = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+@dataclass
+class Workers:
+    workers: List[Worker]
+    command: List[str]
+    env: dict = field(default_factory=dict)
+
+    def start(self, worker: Worker) -> None:
+        worker.process = subprocess.Popen(
+            self.command + [f"--server.port={worker.port}"], env=self.env
+        )
+        worker.connections = 0
+
+    def wait_until_healthy(self, worker: Worker) -> None:
+        start = time.monotonic()
+        while time.monotonic() - start < WORKER_BOOT_TIMEOUT_SECONDS:
+            try:
+                with urllib.request.urlopen(f"{worker.url}/_stcore/health", timeout=1):
+                    return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.1)
+        raise TimeoutError(f"The worker on port {worker.port} did not boot.")
+
+    def restart_exited(self) -> None:
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is not None:
+                print(f"Worker on port {worker.port} exited, restarting it.")
+                self.start(worker)
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.wait()
+
+    def assign(self, handler: tornado.web.RequestHandler) -> Worker:
+        """
+        :param handler: The handler of a request from a browser.
+        :return: The worker of the browser. Browsers without one are assigned the
+            worker with the fewest connections.
+        """
+        index = handler.get_cookie(WORKER_COOKIE)
+        if index is not None and index.isdigit() and int(index) < len(self.workers):
+            return self.workers[int(index)]
+        worker = min(self.workers, key=lambda w: w.connections)
+        handler.set_cookie(
+            WORKER_COOKIE, str(self.workers.index(worker)), httponly=True
+        )
+        return worker
+
+
+def forwarded_headers(handler: tornado.web.RequestHandler, exclude: set) -> HTTPHeaders:
+    """
+    :return: The headers of the request to send to the worker. The Host header
+        is kept, so that the worker checks the origin against the public host.
+    """
+    headers = HTTPHeaders()
+    for name, value in handler.request.headers.get_all():
+        if name.lower() not in HOP_BY_HOP_HEADERS | exclude:
+            headers.add(name, value)
+    headers.add("X-Forwarded-For", handler.request.remote_ip)
+    return headers
+
+
+class ProxyHandler(tornado.web.RequestHandler):
+    """
+    Forwards HTTP requests to the worker of the browser.
+    """
+
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS")
+
+    def initialize(self, workers: Workers) -> None:
+        self.workers = workers
+
+    def check_xsrf_cookie(self) -> None:
+        # The worker checks it.
+        pass
+
+    async def _forward(self) -> None:
+        worker = self.workers.assign(self)
+        response = await tornado.httpclient.AsyncHTTPClient().fetch(
+            tornado.httpclient.HTTPRequest(
+                worker.url + self.request.uri,
+                method=self.request.method,
+                headers=forwarded_headers(self, {"content-length"}),
+                body=self.request.body if self.request.body else None,
+                allow_nonstandard_methods=True,
+                follow_redirects=False,
+                decompress_response=False,
+            ),
+            raise_error=False,
+        )
+        if response.code == 599:
+            self.send_error(502)
+            return
+
+        self.set_status(response.code, response.reason)
+        for name in ["Content-Type", "Server", "Date"]:
+            self.clear_header(name)
+        for name, value in response.headers.get_all():
+            if name.lower() not in HOP_BY_HOP_HEADERS | {"content-length"}:
+                self.add_header(name, value)
+        if response.body:
+            self.write(response.body)
+
+    get = head = post = put = delete = patch = options = _forward
+
+
+class WebSocketProxyHandler(tornado.websocket.WebSocketHandler):
+    """
+    Forwards the WebSocket connection of a browser, which carries its session,
+    to its worker.
+    """
+
+    def initialize(self, workers: Workers) -> None:
+        self.workers = workers
+        self.worker: Optional[Worker] = None
+        self.upstream: Optional[tornado.websocket.WebSocketClientConnection] = None
+
+    def check_origin(self, origin: str) -> bool:
+        # The worker checks it.
+        return True
+
+    def select_subprotocol(self, subprotocols: List[str]) -> Optional[str]:
+        # Streamlit selects the first one, the others carry tokens.
+        return subprotocols[0] if subprotocols else None
+
+    async def open(self, *args, **kwargs) -> None:
+        self.worker = self.workers.assign(self)
+        self.worker.connections += 1
+        subprotocols = [
+            p.strip()
+            for p in self.request.headers.get("Sec-WebSocket-Protocol", "").split(",")
+            if p.strip()
+        ]
+        try:
+            self.upstream = await tornado.websocket.websocket_connect(
+                tornado.httpclient.HTTPRequest(
+                    self.worker.url.replace("http", "ws", 1) + self.request.uri,
+                    headers=forwarded_headers(self, WEBSOCKET_HEADERS),
+                ),
+                on_message_callback=self._on_upstream_message,
+                max_message_size=MAX_MESSAGE_SIZE,
+                subprotocols=subprotocols or None,
+            )
+        except (OSError, tornado.httpclient.HTTPClientError):
+            self.close(1011, "The app worker is not available.")
+
+    def _on_upstream_message(self, message: Union[str, bytes, None]) -> None:
+        if message is None:
+            self.close()
+            return
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, message: Union[str, bytes]) -> None:
+        if self.upstream is not None:
+            self.upstream.write_message(message, binary=isinstance(message, bytes))
+
+    def on_close(self) -> None:
+        if self.worker is not None:
+            self.worker.connections -= 1
+            self.worker = None
+        if self.upstream is not None:
+            self.upstream.close()
+            self.upstream = None
+
+
+async def serve(workers: Workers, port: int, address: str) -> None:
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=100)
+    application = tornado.web.Application(
+        [
+            (r"/_stcore/stream", WebSocketProxyHandler, {"workers": workers}),
+            (r".*", ProxyHandler, {"workers": workers}),
+        ],
+        websocket_max_message_size=MAX_MESSAGE_SIZE,
+    )
+    application.listen(port, address)
+    print(f"Serving {len(workers.workers)} app workers on http://{address}:{port}")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, stopped.set)
+    while not stopped.is_set():
+        workers.restart_exited()
+        try:
+            await asyncio.wait_for(stopped.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=min(os.cpu_count() or 1, AI_MAX_CONCURRENT_REQUESTS),
+        help="App workers.",
+    )
+    parser.add_argument("--port", type=int, default=8501, help="Public port.")
+    parser.add_argument("--address", default="0.0.0.0", help="Public address.")
+    parser.add_argument(
+        "--shared-state",
+        default="results/shared_state.db",
+        help="SQLite database of the state shared by the workers.",
+    )
+    args = parser.parse_args()
+    # Each worker sends at least one request at a time.
+    if not 1 <= args.workers <= AI_MAX_CONCURRENT_REQUESTS:
+        parser.error(
+            f"--workers must be between 1 and AI_MAX_CONCURRENT_REQUESTS "
+            f"({AI_MAX_CONCURRENT_REQUESTS})."
+        )
+
+    env = dict(
+        os.environ,
+        SHARED_STATE_DB_PATH=args.shared_state,
+        APP_WORKERS=str(args.workers),
+    )
+    command = [
+        sys.executable,
+        "-m",
+        "streamlit",
+        "run",
+        "app.py",
+        "--server.headless=true",
+        "--server.address=127.0.0.1",
+    ]
+    workers = Workers(
+        [Worker(args.port + 1 + i) for i in range(args.workers)], command, env
+    )
+    try:
+        for worker in workers.workers:
+            workers.start(worker)
+        for worker in workers.workers:
+            workers.wait_until_healthy(worker)
+        asyncio.run(serve(workers, args.port, args.address))
+    finally:
+        workers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,36 @@
-import os
 import time
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-import pandas as pd
 import streamlit as st
 
-from config import Group
+from ai_jobs import AIJob, Priority
+from case_viewer import display_case_viewer, display_citations
+from config import AI_CASCADE_DRAFT_MODEL, AI_PREFETCH_DELAY_SECONDS, Group
+from events import EventKind
+from hypotheses import canonicalize_hypotheses, canonicalize_hypothesis
+from images import get_case_image_path, get_derivative
+from records import AIHelpRecord
+from responses import MalformedResponseError, check_hypotheses, parse_response
+from retrieval import get_prompt_case_description
+from tokens import PromptTooLongError
 from utils import (
-    get_ai_prompt,
+    evaluate_message,
+    get_ai_request,
+    get_ai_worker_pool,
     get_case_description,
     get_case_index,
-    get_chat_completion,
+    get_cascade,
     get_group,
     get_hypotheses,
-    get_json_schema,
     get_latest_message_content,
+    get_model,
+    get_prompt_hash,
+    get_session_id,
+    log_event,
     page_setup,
-    parse_case_description,
-    parse_message,
     save_widget,
+    submit_chat_completion,
 )
 
 #######################################
@@ -35,14 +46,40 @@ if "case_index" not in st.session_state:
 if "citations" not in st.session_state:
     st.session_state["citations"] = None
 
+if "prefetched_ai_help" not in st.session_state:
+    st.session_state["prefetched_ai_help"] = {}
+
+if "hypotheses_changed_at" not in st.session_state:
+    st.session_state["hypotheses_changed_at"] = time.time()
+
+if "ai_help_requested_at" not in st.session_state:
+    st.session_state["ai_help_requested_at"] = None
+
+# AI help records of the session, by prompt hash.
+if "ai_help" not in st.session_state:
+    st.session_state["ai_help"] = {}
+
+# Jobs of the AI help shown, by model and prompt hash, so that failed requests are
+# only sent again when the participant asks for it.
+if "ai_help_jobs" not in st.session_state:
+    st.session_state["ai_help_jobs"] = {}
+
 if f"case_{get_case_index()}_start_time" not in st.session_state["results"]:
     st.session_state["results"][
         f"case_{get_case_index()}_start_time"
     ] = datetime.now().time()
+    log_event(EventKind.CASE_START)
 
 if f"case_{get_case_index()}_hypotheses" not in st.session_state["results"]:
     st.session_state["results"][f"case_{get_case_index()}_hypotheses"] = []
 
+# Canonical forms of the hypotheses saved in the results, for deduplication.
+if f"case_{get_case_index()}_saved_hypotheses" not in st.session_state:
+    st.session_state[f"case_{get_case_index()}_saved_hypotheses"] = {
+        canonicalize_hypothesis(h, get_case_index())
+        for h in st.session_state["results"][f"case_{get_case_index()}_hypotheses"]
+    }
+
 
 #######################################
 # HELPER FUNCTIONS
@@ -51,27 +88,48 @@ if f"case_{get_case_index()}_hypotheses" not in st.session_state["results"]:
 
 def save_all_hypotheses(hypotheses_table: Dict):
     case_key = f"case_{get_case_index()}"
+    saved_hypotheses = st.session_state[f"{case_key}_saved_hypotheses"]
     for row in hypotheses_table.get("added_rows", []):
         hypothesis = row["hypothesis"]
-        if hypothesis not in st.session_state["results"][f"{case_key}_hypotheses"]:
+        canonical = canonicalize_hypothesis(hypothesis, get_case_index())
+        if canonical not in saved_hypotheses:
+            saved_hypotheses.add(canonical)
             st.session_state["results"][f"{case_key}_hypotheses"].append(hypothesis)
 
 
-def validate_hypotheses(group: Group, hypotheses: List[str]) -> bool:
+def get_invalid_hypotheses(hypotheses: List[str]) -> List[str]:
+    """
+    :param hypotheses: The hypotheses as entered by the user.
+    :return: The hypotheses without any letter or digit, which have no canonical
+        form and would be left out of the AI request.
+    """
+    return [h for h in hypotheses if not canonicalize_hypothesis(h, get_case_index())]
+
+
+def validate_hypotheses(
+    group: Group, hypotheses: List[str], selected_hypotheses: List[str]
+) -> bool:
+    if get_invalid_hypotheses(hypotheses):
+        st.status(
+            label="Please remove the hypotheses without any letter or digit.",
+            expanded=False,
+            state="error",
+        )
+        return False
     if group is Group.HYPOTHESIS_DRIVEN:
-        if len(hypotheses) == 0:
+        if len(selected_hypotheses) == 0:
             st.status(
                 label="Please select one hypothesis.", expanded=False, state="error"
             )
             return False
-        if len(hypotheses) > 1:
+        if len(selected_hypotheses) > 1:
             st.status(
                 label="Please select only one hypothesis.",
                 expanded=False,
                 state="error",
             )
             return False
-    elif group is Group.RECOMMENDATIONS_DRIVEN and len(hypotheses) == 0:
+    elif group is Group.RECOMMENDATIONS_DRIVEN and len(selected_hypotheses) == 0:
         st.status(
             label="Please add at least one hypothesis.", expanded=False, state="error"
         )
@@ -85,14 +143,13 @@ def validate_hypotheses(group: Group, hypotheses: List[str]) -> bool:
 
 
 def display_case_description():
-    st.write(
-        parse_case_description(
-            get_case_description(get_case_index()), st.session_state["citations"]
-        )
-    )
+    display_case_viewer(get_case_index(), st.session_state["citations"])
 
 
 def display_hypothesis_input(group: Group, key: str):
+    # Imported here rather than with the page, the data editor loads pandas
+    # anyway and the title is sent in the meantime.
+    import pandas as pd
 
     columns = ["hypothesis"]
     column_config = {
@@ -129,63 +186,296 @@ def on_hypotheses_change():
         sorted_rows = sorted(hypotheses_table["added_rows"], key=lambda x: x["hypothesis"].lower())
         hypotheses_table["added_rows"] = sorted_rows
 
+    st.session_state["hypotheses_changed_at"] = time.time()
+    log_event(
+        EventKind.HYPOTHESES_EDIT,
+        hypotheses=len(hypotheses_table.get("added_rows", [])),
+    )
+    # Recommendations must be asked for again for the new hypotheses.
+    st.session_state["ai_help_requested_at"] = None
+
     #st.toast("Hypotheses updated!")
     st.toast("Hypotheses updated and alphabetically sorted!")
 
 
+def prefetch_ai_help(group: Group, hypotheses_table: dict):
+    """
+    Start computing the AI help in the background, so that it is ready when the
+    participant asks for it. Completions prefetched for other hypotheses are
+    discarded.
+    """
+    hypotheses, selected_hypotheses = get_hypotheses(hypotheses_table)
+    all_valid = not get_invalid_hypotheses(hypotheses)
+    hypotheses, _ = canonicalize_hypotheses(hypotheses, get_case_index())
+    prefetched = st.session_state["prefetched_ai_help"]
+
+    prompt_hash = None
+    if len(selected_hypotheses) != 0 and all_valid:
+        case_description, _ = get_prompt_case_description(get_case_index(), hypotheses)
+        try:
+            prompt, json_schema, tokens = get_ai_request(
+                group, case_description, hypotheses
+            )
+        except PromptTooLongError:
+            pass
+        else:
+            prompt_hash = get_prompt_hash(prompt, json_schema)
+
+    for outdated_hash in [h for h in prefetched if h != prompt_hash]:
+        get_ai_worker_pool().cancel(prefetched.pop(outdated_hash), get_session_id())
+
+    if prompt_hash is not None and prompt_hash not in prefetched:
+        prefetched[prompt_hash] = submit_chat_completion(
+            prompt, json_schema, tokens, Priority.PREFETCH
+        )
+        log_event(EventKind.AI_REQUEST, prompt_hash=prompt_hash, prefetch=True)
+
+
+@st.experimental_fragment(run_every=1)
+def prefetch_ai_help_when_stable(group: Group):
+    changed_at = st.session_state["hypotheses_changed_at"]
+    if time.time() - changed_at >= AI_PREFETCH_DELAY_SECONDS:
+        prefetch_ai_help(group, st.session_state["hypotheses_table"])
+
+
+@st.experimental_fragment(run_every=0.5)
+def wait_for_ai_help(jobs: List[AIJob], label: str = "Waiting for the AI..."):
+    if any(job.done() for job in jobs):
+        st.rerun()
+    if all(job.started_at is None for job in jobs):
+        stats = get_ai_worker_pool().stats()
+        label += (
+            f" ({sum(stats['queued'].values())} requests queued, "
+            f"~{stats['mean_wait_time']:.0f}s wait)"
+        )
+    st.status(label=label, expanded=False, state="running")
+
+
+def submit_ai_help(
+    prompt: str, json_schema: Dict, tokens: int, model: Optional[str] = None
+) -> AIJob:
+    """
+    Submit a request of the AI help, see `submit_chat_completion`. A request whose
+    last job failed is not sent again, the failed job is returned instead.
+    """
+    key = (model or get_model(), get_prompt_hash(prompt, json_schema))
+    job = st.session_state["ai_help_jobs"].get(key)
+    if job is None or job.exception() is None:
+        job = st.session_state["ai_help_jobs"][key] = submit_chat_completion(
+            prompt, json_schema, tokens, model=model
+        )
+    return job
+
+
+def display_ai_error(prompt_hash: str, label: str):
+    """
+    Show that the AI help could not be obtained, with a button to ask for it
+    again.
+    """
+    st.status(label=label, expanded=False, state="error")
+    if st.button("Try again"):
+        jobs = st.session_state["ai_help_jobs"]
+        for key in [key for key in jobs if key[1] == prompt_hash]:
+            del jobs[key]
+        st.rerun()
+
+
+def check_ai_job(job: AIJob, group: Group, hypotheses: List[str]) -> AIJob:
+    """
+    Treat a malformed AI message as a failed job: its completion is discarded so
+    that the request can be sent again.
+
+    :param job: An AI job of the AI help.
+    :param group: The group of the user.
+    :param hypotheses: The hypotheses used in the prompt.
+    :return: The job, or a failed job in its place if it finished with a message
+        not matching the response model of the group.
+    """
+    if not job.done() or job.exception() is not None:
+        return job
+    try:
+        response = parse_response(get_latest_message_content(job.result()) or "", group)
+        check_hypotheses(response, hypotheses)
+    except MalformedResponseError as e:
+        get_ai_worker_pool().discard(job)
+        job = st.session_state["ai_help_jobs"][job.key] = AIJob.from_result(
+            job.key, job.model, job.prompt, job.json_schema, error=e
+        )
+    return job
+
+
+def display_ai_message(
+    group: Group, record: AIHelpRecord, selected_hypotheses: List[str]
+):
+    """
+    Show the AI message of a record for the selected hypotheses, with its
+    citations.
+    """
+    with st.status(label="", expanded=True, state="complete"):
+        if record.raw_message is None:
+            st.write("No AI message received.")
+            return
+        new_hypotheses = record.select(selected_hypotheses)
+        if new_hypotheses:
+            log_event(
+                EventKind.AI_REVEAL,
+                prompt_hash=record.prompt_hash,
+                hypotheses=new_hypotheses,
+            )
+        citations, parsed_message = record.parse(group, selected_hypotheses[0])
+        st.write(parsed_message)
+        display_citations(get_case_index(), citations)
+        if citations and citations != st.session_state["citations"]:
+            log_event(EventKind.CITATION_VIEW, citations=len(citations))
+        st.session_state["citations"] = citations
+
+
 def display_ai_help(group: Group, case_description: str, hypotheses_table: dict):
 
     if group is Group.CONTROL:
         st.write("You are in the control group. You will not receive any AI help.")
         return
 
+    # The AI help counts as revealed when asked for, even if it was prefetched.
+    reveal_time = st.session_state["ai_help_requested_at"] or datetime.now().time()
+
     hypotheses, selected_hypotheses = get_hypotheses(hypotheses_table)
 
     save_all_hypotheses(hypotheses_table)
 
-    if not validate_hypotheses(group, selected_hypotheses):
+    if not validate_hypotheses(group, hypotheses, selected_hypotheses):
         return
 
-    chat_completion = get_chat_completion(
-        get_ai_prompt(group, case_description, hypotheses),
-        get_json_schema(group, hypotheses),
+    canonical_hypotheses, _ = canonicalize_hypotheses(hypotheses, get_case_index())
+
+    # Long cases may be reduced to their passages most relevant to the
+    # hypotheses, the citations are still checked against the whole case.
+    prompt_case_description, passages = get_prompt_case_description(
+        get_case_index(), canonical_hypotheses
     )
+    try:
+        prompt, json_schema, tokens = get_ai_request(
+            group, prompt_case_description, canonical_hypotheses
+        )
+    except PromptTooLongError:
+        st.status(
+            label="The case and hypotheses are too long for the AI, please "
+            "remove some hypotheses.",
+            expanded=False,
+            state="error",
+        )
+        return
 
-    with st.status(label="", expanded=True, state="complete"):
-        raw_message = get_latest_message_content(chat_completion)
-        if raw_message is None:
-            st.write("No AI message received.")
-        else:
-            citations, parsed_message = parse_message(
-                raw_message, hypotheses, selected_hypotheses, get_group()
-            )
-            st.write(parsed_message)
-            display_citations(citations)
-            st.session_state["parsed_message"] = parsed_message
-            st.session_state["citations"] = citations
-            st.session_state["results"][
-                f"case_{get_case_index()}_ai_help_{chat_completion.id}"
-            ] = {
-                "hypotheses": hypotheses,
-                "selected_hypotheses": selected_hypotheses,
-                "raw_message": raw_message,
-                "parsed_message": parsed_message,
-                "citations": citations,
-            }
-
-
-def display_citations(citations: list[str]):
-    """
-    Display the citations.
+    prompt_hash = get_prompt_hash(prompt, json_schema)
+
+    # The draft and the answer replacing it share the same record.
+    record = st.session_state["ai_help"].get(prompt_hash)
+    if record is None:
+        record = st.session_state["ai_help"][prompt_hash] = AIHelpRecord(
+            case_index=get_case_index(),
+            prompt_hash=prompt_hash,
+            hypotheses=hypotheses,
+            selected_hypotheses=(),
+            canonical_hypotheses=canonical_hypotheses,
+            prefetched=prompt_hash in st.session_state["prefetched_ai_help"],
+            reveal_time=reveal_time,
+            passages=passages,
+        )
+        if not record.prefetched:
+            log_event(EventKind.AI_REQUEST, prompt_hash=prompt_hash, prefetch=False)
+
+    # Once answered by the selected model, or once the draft is kept or replaced,
+    # the AI help is served from its record and neither model is asked again.
+    if record.raw_message is not None and (
+        record.draft_shown_time is None
+        or record.main_skipped
+        or record.swap_time is not None
+    ):
+        display_ai_message(group, record, selected_hypotheses)
+        return
 
-    :param citations: The list of citations to display.
-    """
-    citations_string = (
-        "**Citations:**\n\n" if len(citations) > 0 else "No citations found."
+    # In cascade mode, a draft from a faster model is shown until the answer of
+    # the selected model replaces it, or for good if it passes validation.
+    draft_job = None
+    if get_cascade():
+        draft_job = check_ai_job(
+            submit_ai_help(prompt, json_schema, tokens, model=AI_CASCADE_DRAFT_MODEL),
+            group,
+            canonical_hypotheses,
+        )
+        record.draft_model = draft_job.model
+
+    # Malformed drafts are never shown, the answer of the selected model is
+    # awaited instead.
+    draft_ready = (
+        draft_job is not None and draft_job.done() and draft_job.exception() is None
     )
-    for index, citation in enumerate(citations, start=1):
-        citations_string += f"{index}. {citation}\n\n"
-    st.caption(citations_string)
+
+    job = check_ai_job(
+        submit_ai_help(prompt, json_schema, tokens), group, canonical_hypotheses
+    )
+
+    if job.done() and job.exception() is None:
+        shown_job = job
+    elif draft_ready:
+        shown_job = draft_job
+    elif not job.done() or (draft_job is not None and not draft_job.done()):
+        wait_for_ai_help(
+            [j for j in [job, draft_job] if j is not None and not j.done()]
+        )
+        return
+    elif isinstance(job.exception(), MalformedResponseError):
+        display_ai_error(
+            prompt_hash, "The AI answer could not be read, please try again."
+        )
+        return
+    else:
+        display_ai_error(prompt_hash, "The AI could not answer, please try again.")
+        return
+    chat_completion = shown_job.result()
+
+    if shown_job is draft_job and record.draft_shown_time is None:
+        record.draft_shown_time = datetime.now().time()
+        record.draft_raw_message = get_latest_message_content(chat_completion)
+        evaluation = evaluate_message(
+            record.draft_raw_message,
+            group,
+            case_description,
+            canonical_hypotheses,
+        )
+        record.draft_valid = (
+            evaluation["schema_valid"]
+            and evaluation["grounded_citations"] == evaluation["citations"]
+            and evaluation["lead_diagnosis_valid"] is not False
+        )
+        if record.draft_valid:
+            record.main_skipped = True
+            get_ai_worker_pool().cancel(job, get_session_id())
+    # The draft is also kept for good when the selected model failed to answer,
+    # rather than asking it again and again.
+    if shown_job is draft_job and job.exception() is not None:
+        record.main_skipped = True
+    if shown_job is job and record.draft_shown_time is not None:
+        if record.swap_time is None:
+            record.swap_time = datetime.now().time()
+
+    raw_message = get_latest_message_content(chat_completion)
+    if raw_message is not None and record.raw_message != raw_message:
+        log_event(
+            EventKind.AI_RESPONSE,
+            prompt_hash=prompt_hash,
+            model=chat_completion.model,
+            api_latency=shown_job.latency,
+        )
+    # The model asked, or the one a replayed message was recorded with. The API
+    # answers with e.g. a dated version of it.
+    record.model = shown_job.model
+    record.raw_message = raw_message
+    record.api_latency = shown_job.latency
+    display_ai_message(group, record, selected_hypotheses)
+
+    if shown_job is draft_job and not record.main_skipped:
+        wait_for_ai_help([job], label="Draft answer, a more thorough one is coming...")
 
 
 @st.experimental_dialog("Are you sure you want to move on to the next case?")  # type: ignore
@@ -195,11 +485,18 @@ def dialog_case_done():
         st.session_state["results"][
             f"case_{get_case_index()}_end_time"
         ] = datetime.now().time()
+        log_event(EventKind.CASE_END)
         save_widget("hypotheses_table", new_name=f"case_{get_case_index()}_hypotheses")
+        st.session_state["ai_help_requested_at"] = None
 
         st.switch_page("pages/03_case_questionnaire.py")
 
 
+@st.experimental_dialog("Case image", width="large")  # type: ignore
+def dialog_case_image(image_path: str):
+    st.image(get_derivative(image_path, "full").data, use_column_width=True)
+
+
 #######################################
 # MAIN
 #######################################
@@ -208,12 +505,15 @@ def dialog_case_done():
 st.title(f"Case {get_case_index() + 1}")
 
 # Check if there is an image in the data folder and display it.
-if os.path.exists(f"data/case_{get_case_index()}.jpg"):
+image_path = get_case_image_path(get_case_index())
+if image_path is not None:
     text_col, image_col = st.columns([0.8, 0.2])
     with text_col:
         case_description_container = st.container(height=400)
     with image_col:
-        st.image(f"data/case_{get_case_index()}.jpg", use_column_width=True)
+        st.image(get_derivative(image_path, "thumbnail").data, use_column_width=True)
+        if st.button("View full size"):
+            dialog_case_image(image_path)
 # If there is no image, just display the case description.
 else:
     case_description_container = st.container(height=400)
@@ -223,7 +523,10 @@ with col1:
     hypotheses_df = display_hypothesis_input(get_group(), key="hypotheses_table")
 with col2:
     if get_group() is Group.RECOMMENDATIONS_DRIVEN:
+        prefetch_ai_help_when_stable(get_group())
         if st.button("See AI Recommendations"): # only show recommendations when the button is pressed
+            st.session_state["ai_help_requested_at"] = datetime.now().time()
+        if st.session_state["ai_help_requested_at"] is not None:
             display_ai_help(
                 get_group(),
                 get_case_description(get_case_index()),
@@ -255,3 +558,4 @@ if st.button("Next", disabled=not st.session_state["concluded"]):
 with st.sidebar:
     st.header("Debug")
     st.write(st.session_state)
+    st.write(get_ai_worker_pool().stats())
@@ -1,9 +1,14 @@
-import json
+import os
+import sqlite3
 from datetime import datetime
 
 import streamlit as st
 
-from utils import page_setup
+from config import REPLAY_RESULTS_FOLDER, Backend
+from progress import SessionsTable, summarize_session
+from records import dump_results, get_transcripts
+from transcripts import TranscriptStore
+from utils import get_backend, get_group, get_session_id, page_setup
 
 #######################################
 # SETUP
@@ -13,15 +18,61 @@ from utils import page_setup
 page_setup("Interview")
 
 
+#######################################
+# HELPER FUNCTIONS
+#######################################
+
+
+def save_results(session: str):
+    """
+    Save the results of the session, and add it to the study progress.
+
+    :param session: The name of the session, used for its results file.
+    """
+    # Links the results to the events of the session.
+    st.session_state["results"]["session_id"] = get_session_id()
+    ai_help_records = st.session_state.get("ai_help", {}).values()
+    # Sessions served from recorded completions are not part of the study.
+    replayed = get_backend() is not Backend.OPENAI
+    results_folder = REPLAY_RESULTS_FOLDER if replayed else "results"
+    os.makedirs(results_folder, exist_ok=True)
+    results_path = os.path.join(results_folder, f"{session}.json")
+    open(results_path, "x").write(
+        dump_results(st.session_state["results"], ai_help_records)
+    )
+    # The prompts and messages are then stored compressed, out of the results
+    # file. If that fails, they stay in it until `python transcripts.py compress`.
+    try:
+        TranscriptStore(os.path.join(results_folder, "transcripts.db")).put(
+            get_transcripts(session, get_group(), ai_help_records)
+        )
+    except sqlite3.Error:
+        pass
+    else:
+        open(results_path, "w").write(
+            dump_results(st.session_state["results"], ai_help_records, messages=False)
+        )
+    if not replayed:
+        SessionsTable().append(
+            session,
+            get_group().value,
+            summarize_session(
+                st.session_state["results"], [r.api_latency for r in ai_help_records]
+            ),
+        )
+
+
 #######################################
 # MAIN
 #######################################
 
 st.title("Semi-structured interview")
 
-open(f"results/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json", "x").write(
-    json.dumps(st.session_state["results"], default=str)
-)
+# The results are saved once, however often the page is rerun.
+if "saved_session" not in st.session_state:
+    session = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    save_results(session)
+    st.session_state["saved_session"] = session
 
 with st.sidebar:
     st.header("Debug")
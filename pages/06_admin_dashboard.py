@@ -0,0 +1,63 @@
+import pandas as pd
+import streamlit as st
+
+from config import DASHBOARD_REFRESH_SECONDS
+from progress import MEASURES
+from utils import get_study_progress, page_setup
+
+#######################################
+# SETUP
+#######################################
+
+
+page_setup("Admin dashboard")
+
+if st.secrets.get("ADMIN_PASSWORD") is not None:
+    if st.text_input("Password", type="password") != st.secrets["ADMIN_PASSWORD"]:
+        st.stop()
+
+
+#######################################
+# DISPLAYS
+#######################################
+
+
+@st.experimental_fragment(run_every=DASHBOARD_REFRESH_SECONDS)
+def display_progress():
+    progress = get_study_progress()
+    progress.update()
+
+    st.caption(f"Last updated at {progress.updated_at:%H:%M:%S}.")
+    if len(progress.groups) == 0:
+        st.write("No session completed yet.")
+        return
+
+    st.dataframe(
+        pd.DataFrame.from_dict(
+            {
+                group: {
+                    "sessions": stats.sessions,
+                    **{
+                        measure: (
+                            f"{stats.measures[measure].mean:.2f} ± "
+                            f"{stats.measures[measure].std:.2f} "
+                            f"(n={stats.measures[measure].count})"
+                        )
+                        for measure in MEASURES
+                    },
+                }
+                for group, stats in sorted(progress.groups.items())
+            },
+            orient="index",
+        ),
+        use_container_width=True,
+    )
+
+
+#######################################
+# MAIN
+#######################################
+
+st.title("Study progress")
+
+display_progress()
@@ -0,0 +1,190 @@
+"""
+This file contains the study progress tracking shown on the admin dashboard.
+
+When a session completes, a one-row summary of it is appended to a sessions
+table. The dashboard tails that table from a cursor and folds the new rows into
+per-group running statistics, so that the historical sessions are never read
+again, however many there are.
+"""
+
+import math
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, time
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import NUMBER_OF_CASES, SESSIONS_DB_PATH
+from questionnaire import REVERSE_SCORED_QUESTIONS
+
+# Measures summarized for each session.
+MEASURES = [
+    "mean_time",
+    "mean_confidence",
+    "ai_trust_before",
+    "ai_trust_after",
+    "ai_trust_diff",
+    "mean_api_latency",
+]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    "group" TEXT NOT NULL,
+    {", ".join(f"{measure} REAL" for measure in MEASURES)}
+);
+"""
+
+
+@dataclass(slots=True)
+class RunningStats:
+    """
+    Count, mean and variance of a measure, updated one value at a time with
+    Welford's algorithm.
+    """
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def add(self, value: Optional[float]) -> None:
+        if value is None or math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+@dataclass(slots=True)
+class GroupStats:
+    sessions: int = 0
+    measures: Dict[str, RunningStats] = field(
+        default_factory=lambda: {measure: RunningStats() for measure in MEASURES}
+    )
+
+
+def _mean(values: Iterable[Optional[float]]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+def _seconds_between(start: Optional[time], end: Optional[time]) -> Optional[float]:
+    if start is None or end is None:
+        return None
+    seconds = (
+        datetime.combine(datetime.min, end) - datetime.combine(datetime.min, start)
+    ).total_seconds()
+    # Times are saved without dates, a case ending after midnight wraps around.
+    return seconds % (24 * 60 * 60)
+
+
+def _trust(results: Dict[str, Any], moment: str) -> Optional[float]:
+    return _mean(
+        (
+            REVERSE_SCORED_QUESTIONS[key].score(value)
+            if key in REVERSE_SCORED_QUESTIONS
+            else value
+        )
+        for key, value in results.items()
+        if key.startswith(f"ai_trust_{moment}_") and value is not None
+    )
+
+
+def summarize_session(
+    results: Dict[str, Any], api_latencies: Iterable[Optional[float]]
+) -> Dict[str, Optional[float]]:
+    """
+    :param results: The results of the session.
+    :param api_latencies: The API latencies of the AI help of the session.
+    :return: The measures of the session, as computed in the analysis notebook.
+    """
+    summary = {
+        "mean_time": _mean(
+            _seconds_between(
+                results.get(f"case_{i}_start_time"), results.get(f"case_{i}_end_time")
+            )
+            for i in range(NUMBER_OF_CASES)
+        ),
+        "mean_confidence": _mean(
+            results.get(f"case_{i}_confidence_level") for i in range(NUMBER_OF_CASES)
+        ),
+        "ai_trust_before": _trust(results, "before"),
+        "ai_trust_after": _trust(results, "after"),
+        "mean_api_latency": _mean(api_latencies),
+    }
+    summary["ai_trust_diff"] = (
+        summary["ai_trust_after"] - summary["ai_trust_before"]
+        if summary["ai_trust_after"] is not None
+        and summary["ai_trust_before"] is not None
+        else None
+    )
+    return summary
+
+
+class SessionsTable:
+    """
+    Append-only table of the summaries of the completed sessions.
+    """
+
+    def __init__(self, path: str = SESSIONS_DB_PATH):
+        self.path = path
+        with sqlite3.connect(self.path) as connection:
+            connection.executescript(SCHEMA)
+
+    def append(
+        self, session: str, group: str, summary: Dict[str, Optional[float]]
+    ) -> None:
+        with sqlite3.connect(self.path, timeout=30) as connection:
+            connection.execute(
+                f'INSERT INTO sessions (session, "group", {", ".join(MEASURES)}) '
+                f"VALUES (?, ?, {', '.join('?' for _ in MEASURES)})",
+                (session, group, *(summary[measure] for measure in MEASURES)),
+            )
+
+    def tail(self, cursor: int) -> List[sqlite3.Row]:
+        """
+        :param cursor: The id of the last row read.
+        :return: The rows added since.
+        """
+        with sqlite3.connect(self.path, timeout=30) as connection:
+            connection.row_factory = sqlite3.Row
+            return connection.execute(
+                "SELECT * FROM sessions WHERE id > ? ORDER BY id", (cursor,)
+            ).fetchall()
+
+
+class StudyProgress:
+    """
+    Per-group running statistics of the completed sessions, kept up to date by
+    tailing the sessions table.
+    """
+
+    def __init__(self, table: SessionsTable):
+        self._table = table
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self.groups: Dict[str, GroupStats] = {}
+        self.updated_at: Optional[datetime] = None
+
+    def update(self) -> int:
+        """
+        Fold the sessions completed since the last update into the statistics.
+
+        :return: The number of new sessions.
+        """
+        with self._lock:
+            rows = self._table.tail(self._cursor)
+            for row in rows:
+                stats = self.groups.setdefault(row["group"], GroupStats())
+                stats.sessions += 1
+                for measure in MEASURES:
+                    stats.measures[measure].add(row[measure])
+                self._cursor = row["id"]
+            self.updated_at = datetime.now()
+            return len(rows)
@@ -0,0 +1,424 @@
+"""
+This file contains the questionnaires of the study and the engine rendering them.
+
+Each questionnaire is declared as sections of questions. A questionnaire is
+rendered as a form, so that answering a question does not rerun the page: the
+answers are all sent when the participant clicks "Next", and saved to the
+results at once.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import streamlit as st
+
+
+@dataclass(frozen=True)
+class Question:
+    """
+    A question answered with a radio button. The answer is saved under the key.
+    """
+
+    key: str
+    text: str
+    options: Sequence[Any] = range(1, 6)
+    # Labels shown for the options, by default the options themselves.
+    labels: Optional[Sequence[str]] = None
+    # Captions shown under the options, if any.
+    captions: Optional[Sequence[str]] = None
+    horizontal: bool = False
+    # Whether a higher answer means less of what is measured, e.g. "I am wary of
+    # the AI" for trust. The answer is saved as given, and reversed in analysis.
+    reverse_scored: bool = False
+
+    def score(self, answer: Any) -> Any:
+        """
+        :param answer: An answer to the question, as saved.
+        :return: The answer, reversed on the scale of the options if the question
+            is reverse scored.
+        """
+        if not self.reverse_scored:
+            return answer
+        return min(self.options) + max(self.options) - answer
+
+
+@dataclass(frozen=True)
+class Section:
+    questions: Sequence[Question]
+    # Instructions shown before the questions, if any.
+    instructions: Optional[str] = None
+
+
+# Indices of the trust statements whose scale is reversed, "I am wary of the AI".
+REVERSED_TRUST_ITEMS = [5]
+
+AGREEMENT_LABELS = [
+    "1 - I disagree strongly",
+    "2 - I disagree somewhat",
+    "3 - I'm neutral about it",
+    "4 - I agree somewhat",
+    "5 - I agree strongly",
+]
+
+
+def get_ai_trust_section(moment: str, statements: List[str], seen: str) -> Section:
+    """
+    :param moment: "before" or "after" the experiment, used in the keys.
+    :param statements: The statements of the trust questionnaire, in the tense
+        of the moment.
+    :param seen: "will see" or "saw", the AI the instructions refer to.
+    :return: The trust in automation section.
+    """
+    return Section(
+        instructions=(
+            "**Please mark each statement with the number that best "
+            "describes your feelings or your impression of trust with the "
+            f"AI you {seen}.**"
+        ),
+        questions=[
+            Question(
+                key=f"ai_trust_{moment}_{i}",
+                text=f"**{statement}**",
+                labels=AGREEMENT_LABELS,
+                horizontal=True,
+                reverse_scored=i in REVERSED_TRUST_ITEMS,
+            )
+            for i, statement in enumerate(statements)
+        ],
+    )
+
+
+#######################################
+# QUESTIONNAIRES
+#######################################
+
+
+DOMAIN_AI_EXPERTISE = [
+    Section(
+        [
+            Question(
+                "background",
+                "Select your background",
+                ["Resident", "Registrar", "Consultant"],
+            ),
+            Question(
+                "domain_experience",
+                "How many years of experience do you have?",
+                [
+                    "0-1 year",
+                    "2-4 years",
+                    "5-9 years",
+                    "10-14 years",
+                    "15-19 years",
+                    "20-24 years",
+                    "25+ years",
+                ],
+            ),
+            Question(
+                "llm_usage",
+                (
+                    "How often do you use Large Language Models (LLMs, e.g., "
+                    "ChatGPT, Bing Chat, Google Bard / Gemini) "
+                    "in any context (not just professional)?"
+                ),
+                [
+                    "I have never used such tools",
+                    "I have tried such tools before, but do not use them regularly",
+                    "I use such tools monthly",
+                    "I use such tools weekly",
+                    "I use such tools daily",
+                ],
+            ),
+            Question(
+                "ai_study",
+                "Have you ever studied anything related to AI?",
+                ["Yes", "No"],
+            ),
+        ]
+    ),
+    get_ai_trust_section(
+        "before",
+        [
+            "I am confident in the AI. I feel that it will work well.",
+            "The outputs of the AI will be very predictable.",
+            "The AI will be very reliable. I can count on it to be correct all the "
+            "time.",
+            "I feel safe that when I will rely on the AI I will get the right "
+            "answers.",
+            "The AI will be efficient in that it works very quickly.",
+            "I am wary of the AI.",
+            "The AI will be able to perform the task better than a novice human "
+            "user.",
+            "I will like using the AI for decision making.",
+        ],
+        "will see",
+    ),
+]
+
+CASE = [
+    Section(
+        [
+            Question(
+                "confidence_level",
+                (
+                    "**Please rate your confidence level in your clinical "
+                    "reasoning for this case, on a scale of 1 to 5:**"
+                ),
+                labels=[
+                    "1 - Very low confidence",
+                    "2 - Low confidence",
+                    "3 - Neutral",
+                    "4 - High confidence",
+                    "5 - Very high confidence",
+                ],
+                captions=[
+                    (
+                        "You have minimal confidence in the accuracy of your "
+                        "diagnosis or in the reasoning leading you to it."
+                    ),
+                    "",
+                    (
+                        "You feel neither particularly confident nor doubtful "
+                        "about your diagnosis or your reasoning."
+                    ),
+                    "",
+                    (
+                        "You have great confidence in your diagnosis and in your "
+                        "reasoning, believing your conclusions to be highly "
+                        "accurate and reliable."
+                    ),
+                ],
+            ),
+            Question(
+                "contentment_level",
+                (
+                    "**Please rate your level of agreement with the following "
+                    'statement – on a scale of 1 to 5: "Given the complexity of '
+                    "this case and the information available, I am satisfied "
+                    'that I did my best in my clinical reasoning"**'
+                ),
+                labels=[
+                    "1 - Strongly disagree",
+                    "2 - Disagree",
+                    "3 - Neutral",
+                    "4 - Agree",
+                    "5 - Strongly agree",
+                ],
+                captions=[
+                    (
+                        "You feel extremely dissatisfied with the thoroughness of "
+                        "your clinical reasoning, feeling like more options "
+                        "should be considered or some decisions better justified, "
+                        "even with just the information available to you."
+                    ),
+                    "",
+                    (
+                        "You feel neither particularly satisfied nor dissatisfied "
+                        "with the thoroughness of your clinical reasoning, "
+                        "considering it adequate but not exceptional."
+                    ),
+                    "",
+                    (
+                        "You are extremely satisfied with the thoroughness of "
+                        "your clinical reasoning, having carefully considered all "
+                        "options and arrived at a logical conclusion given the "
+                        "information available to you."
+                    ),
+                ],
+            ),
+        ]
+    )
+]
+
+CONDITION = [
+    Section(
+        [
+            Question(
+                "perceived_helpfulness",
+                (
+                    "**Please indicate to what extent you perceive the clinical "
+                    "decision aids you used as beneficial in assisting you with "
+                    "your clinical reasoning, on a scale of 1 to 5:**"
+                ),
+                labels=[
+                    "1 - Not helpful at all",
+                    "2 - Somewhat helpful",
+                    "3 - Moderately helpful",
+                    "4 - Very helpful",
+                    "5 - Extremely helpful",
+                ],
+                captions=[
+                    (
+                        "The absence of the clinical decision aids would not have "
+                        "affected you at all."
+                    ),
+                    "",
+                    (
+                        "The clinical decision aids helped you in your reasoning "
+                        "on multiple occasions."
+                    ),
+                    "",
+                    (
+                        "The clinical decision aids were instrumental in "
+                        "achieving the quality of clinical reasoning you achieved."
+                    ),
+                ],
+            ),
+            Question(
+                "agency",
+                (
+                    "**Please rate your sense of agency/control in your clinical "
+                    "reasoning, on a scale of 1 to 5:**"
+                ),
+                labels=[
+                    "1 - No control/agency",
+                    "2 - Low control/agency",
+                    "3 - Neutral",
+                    "4 - High control/agency",
+                    "5 - Complete control/agency",
+                ],
+                captions=[
+                    "You feel completely powerless or without influence over the "
+                    "outcome.",
+                    "",
+                    (
+                        "You feel neither particularly empowered nor powerless, "
+                        "with a moderate level of control/agency."
+                    ),
+                    "",
+                    (
+                        "You feel completely empowered and in full control of the "
+                        "outcome, with no doubts about your ability to influence "
+                        "it."
+                    ),
+                ],
+            ),
+            Question(
+                "mental_demand",
+                (
+                    "**Please rate how cognitively demanding your interaction "
+                    "with the clinical decision aids were, on a scale of 1 to 5:**"
+                ),
+                labels=[
+                    "1 - Very low demand",
+                    "2 - Low demand",
+                    "3 - Neutral",
+                    "4 - High demand",
+                    "5 - Very high demand",
+                ],
+                captions=[
+                    (
+                        "Interacting with the clinical decision aids required "
+                        "minimal mental effort."
+                    ),
+                    "",
+                    (
+                        "Interacting with the clinical decision aids required "
+                        "neither high nor low mental effort."
+                    ),
+                    "",
+                    (
+                        "Interacting with the clinical decision aids required "
+                        "intense mental focus and concentration."
+                    ),
+                ],
+            ),
+        ]
+    )
+]
+
+AI_TRUST_AFTER = get_ai_trust_section(
+    "after",
+    [
+        "I am confident in the AI. I feel that it works well.",
+        "The outputs of the AI are very predictable.",
+        "The AI is very reliable. I can count on it to be correct all the time.",
+        "I feel safe that when I rely on the AI I will get the right answers.",
+        "The AI is efficient in that it works very quickly.",
+        "I am wary of the AI.",
+        "The AI can perform the task better than a novice human user.",
+        "I like using the AI for decision making.",
+    ],
+    "saw",
+)
+
+
+# Questions whose answers are reversed in analysis, by key.
+REVERSE_SCORED_QUESTIONS = {
+    question.key: question
+    for section in [*DOMAIN_AI_EXPERTISE, *CASE, *CONDITION, AI_TRUST_AFTER]
+    for question in section.questions
+    if question.reverse_scored
+}
+
+
+#######################################
+# RENDERING
+#######################################
+
+
+def display_question(question: Question) -> None:
+    labels = question.labels
+    st.radio(
+        question.text,
+        question.options,
+        format_func=(
+            (lambda x: labels[list(question.options).index(x)])
+            if labels is not None
+            else str
+        ),
+        captions=question.captions,
+        horizontal=question.horizontal,
+        index=None,
+        key=question.key,
+    )
+
+
+def display_questionnaire(
+    key: str, sections: List[Section], divider: bool = True
+) -> Optional[Dict[str, Any]]:
+    """
+    Display a questionnaire as a form, submitted with a "Next" button.
+
+    :param key: The key of the form.
+    :param sections: The sections of the questionnaire.
+    :param divider: Whether to separate the sections, and the button, with
+        dividers.
+    :return: The answers by question key, once the form is submitted with all
+        the questions answered.
+    """
+    questions = [q for section in sections for q in section.questions]
+
+    with st.form(key, border=False):
+        for i, section in enumerate(sections):
+            if divider and i > 0:
+                st.divider()
+            if section.instructions is not None:
+                st.markdown(section.instructions)
+            for question in section.questions:
+                display_question(question)
+        if divider:
+            st.divider()
+        submitted = st.form_submit_button("Next")
+
+    if not submitted:
+        return None
+    answers = {q.key: st.session_state[q.key] for q in questions}
+    if any(answer is None for answer in answers.values()):
+        st.status(
+            label="Please answer all the questions.", expanded=False, state="error"
+        )
+        return None
+    return answers
+
+
+def save_answers(answers: Dict[str, Any]) -> None:
+    """
+    Save the answers of a questionnaire to the results dictionnary.
+
+    :param answers: The answers, by name in the results.
+    :return: None
+    """
+    assert "results" in st.session_state, "'results' cannot be found in session_state"
+
+    st.session_state["results"].update(answers)
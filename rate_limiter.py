@@ -0,0 +1,114 @@
+"""
+This file contains the process-wide rate limiter keeping the requests sent to the
+OpenAI API under the organization limits.
+
+Each model has two token buckets, one for requests and one for tokens per minute.
+A request is only sent once both buckets hold enough for it, so that we wait
+before sending instead of relying on 429 errors and retries.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class TokenBucket:
+    """
+    Bucket holding up to `capacity` units, refilled continuously at `per_minute`
+    units per minute.
+    """
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        # A bucket updated later than now, e.g. by a clock set back, is not
+        # drained.
+        elapsed = max(0.0, now - self.updated_at)
+        self.level = min(self.capacity, self.level + elapsed * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount: float) -> float:
+        """
+        :param amount: The amount to take from the bucket.
+        :return: The number of seconds until the bucket holds the amount.
+        """
+        self._refill()
+        # Requests larger than the bucket are let through once it is full.
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute limits of each model.
+    """
+
+    def __init__(self, rate_limits: Dict[str, Dict[str, int]]):
+        """
+        :param rate_limits: The "rpm" and "tpm" limits of each model.
+        """
+        self._requests = {
+            model: TokenBucket(limits["rpm"], limits["rpm"])
+            for model, limits in rate_limits.items()
+        }
+        self._tokens = {
+            model: TokenBucket(limits["tpm"], limits["tpm"])
+            for model, limits in rate_limits.items()
+        }
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _synchronized(self) -> Iterator[None]:
+        """
+        Hold the buckets for a read and update.
+        """
+        with self._lock:
+            yield
+
+    def try_acquire(self, model: str, tokens: int) -> float:
+        """
+        Take a request of the given number of tokens from the model budget, if
+        possible.
+
+        :param model: The model the request is sent to.
+        :param tokens: The estimated number of tokens of the request.
+        :return: 0 if the request can be sent now, otherwise the number of seconds
+            to wait before trying again.
+        """
+        if model not in self._requests:
+            return 0.0
+        with self._synchronized():
+            delay = max(
+                self._requests[model].delay(1), self._tokens[model].delay(tokens)
+            )
+            if delay == 0:
+                self._requests[model].take(1)
+                self._tokens[model].take(tokens)
+            return delay
+
+    def settle(self, model: str, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Correct the model budget once the actual token usage of a request is known.
+
+        :param model: The model the request was sent to.
+        :param estimated_tokens: The number of tokens taken when sending the request.
+        :param actual_tokens: The number of tokens used, as reported by the API.
+        """
+        if model not in self._tokens:
+            return
+        with self._synchronized():
+            self._tokens[model].give(estimated_tokens - actual_tokens)
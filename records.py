@@ -0,0 +1,173 @@
+"""
+This file contains the compact record of the AI help received during a session.
+
+The AI help is recorded once per prompt hash, however often the page is rerun,
+with interned hypothesis strings shared between the records of a session. The
+parsed message and citations are not stored, they are derived from the raw
+message when needed.
+"""
+
+import json
+import re
+import sys
+from dataclasses import asdict, dataclass
+from datetime import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import Group
+from hypotheses import canonicalize_hypotheses, canonicalize_hypothesis
+from retrieval import Passage, join_passages
+from utils import get_ai_prompt, get_case_description, parse_message
+
+AI_HELP_KEY_PATTERN = re.compile(r"case_(\d+)_ai_help_.+")
+
+
+def intern_all(strings: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sys.intern(s) for s in strings)
+
+
+@dataclass(slots=True)
+class AIHelpRecord:
+    """
+    The AI help shown for one prompt, and how it was obtained.
+
+    For the hypothesis-driven group, the selected hypotheses are all the
+    hypotheses the AI help was viewed for, in order.
+    """
+
+    case_index: int
+    prompt_hash: str
+    hypotheses: Tuple[str, ...]
+    selected_hypotheses: Tuple[str, ...]
+    canonical_hypotheses: Tuple[str, ...]
+    prefetched: bool
+    reveal_time: time
+    model: Optional[str] = None
+    raw_message: Optional[str] = None
+    api_latency: Optional[float] = None
+    draft_model: Optional[str] = None
+    draft_raw_message: Optional[str] = None
+    draft_valid: Optional[bool] = None
+    draft_shown_time: Optional[time] = None
+    main_skipped: bool = False
+    swap_time: Optional[time] = None
+    # Offsets of the passages of the case description in the prompt, if it was
+    # reduced, see retrieval.py.
+    passages: Optional[Tuple[Passage, ...]] = None
+
+    def __post_init__(self):
+        self.hypotheses = intern_all(self.hypotheses)
+        self.selected_hypotheses = intern_all(self.selected_hypotheses)
+        self.canonical_hypotheses = intern_all(self.canonical_hypotheses)
+
+    @property
+    def key(self) -> str:
+        """
+        :return: The key of the record in the results.
+        """
+        return f"case_{self.case_index}_ai_help_{self.prompt_hash}"
+
+    def select(self, selected_hypotheses: List[str]) -> Tuple[str, ...]:
+        """
+        Record that the AI help was viewed for the given hypotheses.
+
+        :return: The hypotheses the AI help was not viewed for before.
+        """
+        new_hypotheses = intern_all(
+            h for h in selected_hypotheses if h not in self.selected_hypotheses
+        )
+        self.selected_hypotheses += new_hypotheses
+        return new_hypotheses
+
+    def parse(
+        self, group: Group, selected_hypothesis: Optional[str] = None
+    ) -> Tuple[List[str], str]:
+        """
+        Derive the citations and parsed message from the raw message.
+
+        :param group: The group of the user.
+        :param selected_hypothesis: The hypothesis to show the evidence of, for
+            the hypothesis-driven group. Defaults to the last one viewed.
+        :return: A tuple containing the list of citations and the parsed message.
+        """
+        if self.raw_message is None:
+            return [], ""
+        if selected_hypothesis is None:
+            selected_hypothesis = self.selected_hypotheses[-1]
+        _, original_spellings = canonicalize_hypotheses(
+            list(self.hypotheses), self.case_index
+        )
+        return parse_message(
+            self.raw_message,
+            [canonicalize_hypothesis(selected_hypothesis, self.case_index)],
+            group,
+            original_spellings,
+        )
+
+    def get_transcripts(self, group: Group) -> Dict[str, str]:
+        """
+        :param group: The group of the user.
+        :return: The prompt and messages of the record, by kind.
+        """
+        case_description = get_case_description(self.case_index)
+        if self.passages is not None:
+            case_description = join_passages(case_description, self.passages)
+        transcripts = {
+            "prompt": get_ai_prompt(
+                group, case_description, list(self.canonical_hypotheses)
+            ),
+            "raw_message": self.raw_message,
+            "draft_raw_message": self.draft_raw_message,
+        }
+        return {kind: text for kind, text in transcripts.items() if text is not None}
+
+    def to_dict(self, messages: bool = True) -> Dict[str, Any]:
+        """
+        :param messages: Whether to include the messages, or leave them to the
+            transcript store.
+        :return: The record as saved in the results, in field order.
+        """
+        record = asdict(self)
+        del record["case_index"]
+        if not messages:
+            record["raw_message"] = record["draft_raw_message"] = None
+        for name in ["hypotheses", "selected_hypotheses", "canonical_hypotheses"]:
+            record[name] = list(record[name])
+        return record
+
+
+def get_transcripts(
+    session: str, group: Group, ai_help_records: Iterable[AIHelpRecord]
+) -> List[Tuple[str, int, str, str, str]]:
+    """
+    :param session: The session, i.e. the name of its results file.
+    :param group: The group of the user.
+    :param ai_help_records: The AI help records of the session.
+    :return: The transcripts of the records, as stored by the transcript store.
+    """
+    return [
+        (session, record.case_index, record.prompt_hash, kind, text)
+        for record in ai_help_records
+        for kind, text in record.get_transcripts(group).items()
+    ]
+
+
+def dump_results(
+    results: Dict[str, Any],
+    ai_help_records: Iterable[AIHelpRecord],
+    messages: bool = True,
+) -> str:
+    """
+    Serialize the results of a session, with its AI help records. The output
+    only depends on the content, not on the order the entries were added in.
+
+    :param results: The results of the session.
+    :param ai_help_records: The AI help records of the session.
+    :param messages: Whether to include the messages, or leave them to the
+        transcript store.
+    :return: The JSON results.
+    """
+    results = dict(results)
+    for record in ai_help_records:
+        results[record.key] = record.to_dict(messages)
+    return json.dumps(results, default=str, sort_keys=True)
@@ -0,0 +1,131 @@
+"""
+This file contains the replay backend, serving AI completions recorded in the
+results files instead of calling the OpenAI API.
+
+Recorded messages are keyed by prompt hash, and read through the transcript
+store when they were moved there. Results recorded before the prompt hash was
+stored get it recomputed from the group, case and hypotheses.
+"""
+
+from typing import Dict, Optional, Tuple
+
+from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from config import Group
+from records import AI_HELP_KEY_PATTERN
+from transcripts import load_results
+from utils import get_ai_prompt, get_case_description, get_json_schema, get_prompt_hash
+
+
+class ReplayMissError(LookupError):
+    """
+    Raised when no completion was recorded for a prompt.
+    """
+
+
+class ReplayStore:
+    """
+    Recorded raw messages, by prompt hash and model asked.
+    """
+
+    def __init__(self, messages: Dict[str, Dict[str, str]]):
+        self._messages = messages
+
+    @classmethod
+    def from_results(cls, folder_path: str = "results") -> "ReplayStore":
+        """
+        Load the completions recorded in the results files of a folder.
+
+        :param folder_path: The folder containing the results files.
+        :return: The replay store.
+        """
+        messages: Dict[str, Dict[str, str]] = {}
+        for results in load_results(folder_path).values():
+            for key, entry in results.items():
+                match = AI_HELP_KEY_PATTERN.fullmatch(key)
+                if match is None or entry.get("raw_message") is None:
+                    continue
+                prompt_hash = entry.get("prompt_hash")
+                if prompt_hash is None:
+                    # Groups are saved as e.g. "Group.HYPOTHESIS_DRIVEN".
+                    group = Group[results["group"].split(".")[-1]]
+                    case_description = get_case_description(int(match.group(1)))
+                    prompt_hash = get_prompt_hash(
+                        get_ai_prompt(group, case_description, entry["hypotheses"]),
+                        get_json_schema(group, entry["hypotheses"]),
+                    )
+                # When the main model was skipped, the answer is the draft of the
+                # cascade model.
+                model = results["model"]
+                if entry.get("main_skipped"):
+                    model = entry["draft_model"]
+                recorded = messages.setdefault(prompt_hash, {})
+                recorded[model] = entry["raw_message"]
+                if entry.get("draft_raw_message") is not None:
+                    recorded[entry["draft_model"]] = entry["draft_raw_message"]
+        return cls(messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def lookup(
+        self, prompt_hash: str, model: str, other_models: bool = True
+    ) -> Optional[Tuple[str, str]]:
+        """
+        :param prompt_hash: The hash of the prompt and JSON schema.
+        :param model: The model to prefer, if the prompt was recorded for several.
+        :param other_models: Whether to fall back on messages recorded with other
+            models.
+        :return: The model the message was recorded with and the raw message, if
+            any.
+        """
+        recorded = self._messages.get(prompt_hash, {})
+        if model in recorded:
+            return model, recorded[model]
+        if not other_models:
+            return None
+        return next(iter(recorded.items()), None)
+
+    def get(
+        self, prompt_hash: str, model: str, other_models: bool = True
+    ) -> Optional[str]:
+        """
+        :return: The recorded raw message, if any, see `lookup`.
+        """
+        recorded = self.lookup(prompt_hash, model, other_models)
+        return None if recorded is None else recorded[1]
+
+    def get_chat_completion(
+        self, prompt_hash: str, model: str, other_models: bool = True
+    ) -> ChatCompletion:
+        """
+        :param prompt_hash: The hash of the prompt and JSON schema.
+        :param model: The model to prefer, if the prompt was recorded for several.
+        :param other_models: Whether to fall back on messages recorded with other
+            models.
+        :return: A chat completion object holding the recorded message, and the
+            model it was recorded with.
+        :raises ReplayMissError: If no message was recorded for the prompt.
+        """
+        recorded = self.lookup(prompt_hash, model, other_models)
+        if recorded is None:
+            raise ReplayMissError(f"No completion recorded for prompt {prompt_hash}.")
+        model, raw_message = recorded
+
+        return ChatCompletion(
+            # Deterministic, so that replayed results are keyed identically.
+            id=f"replay-{prompt_hash[:24]}",
+            choices=[
+                Choice(
+                    finish_reason="stop",
+                    index=0,
+                    message=ChatCompletionMessage(
+                        role="assistant", content=raw_message
+                    ),
+                )
+            ],
+            created=0,
+            model=model,
+            object="chat.completion",
+        )
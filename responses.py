@@ -0,0 +1,131 @@
+"""
+This file contains the models of the AI responses of both groups.
+
+Raw messages are validated once against these models, and the parsed response is
+cached by message, so that rendering, citation highlighting, the results and the
+analysis all share the same validated object instead of re-reading the JSON.
+"""
+
+from functools import lru_cache
+from typing import Dict, List, Literal, Union
+
+from pydantic import BaseModel, ConfigDict, RootModel, ValidationError
+
+from config import Group
+
+
+class MalformedResponseError(ValueError):
+    """
+    Raised when an AI message does not match the response model of its group.
+    """
+
+
+class Evidence(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    claim: str
+    citations: List[str]
+
+
+class HypothesisEvaluation(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    evidence_for: List[Evidence]
+    evidence_against: List[Evidence]
+
+    @property
+    def citations(self) -> List[str]:
+        """
+        :return: The distinct citations of the evaluation, in order of appearance.
+        """
+        return _unique(
+            c for e in self.evidence_for + self.evidence_against for c in e.citations
+        )
+
+
+class HypothesisDrivenResponse(RootModel[Dict[str, HypothesisEvaluation]]):
+    """
+    Evidence for and against each hypothesis, keyed by hypothesis.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    def __getitem__(self, hypothesis: str) -> HypothesisEvaluation:
+        return self.root[hypothesis]
+
+    @property
+    def hypotheses(self) -> List[str]:
+        return list(self.root)
+
+    @property
+    def citations(self) -> List[str]:
+        """
+        :return: The distinct citations of all the evaluations.
+        """
+        return _unique(c for e in self.root.values() for c in e.citations)
+
+
+class RecommendationsDrivenResponse(BaseModel):
+    """
+    The lead diagnosis recommended by the AI, and its rationale.
+    """
+
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    rationale: str
+    citations: List[str]
+    lead_diagnosis: str
+
+
+Response = Union[HypothesisDrivenResponse, RecommendationsDrivenResponse]
+
+RESPONSE_MODELS = {
+    Group.HYPOTHESIS_DRIVEN: HypothesisDrivenResponse,
+    Group.RECOMMENDATIONS_DRIVEN: RecommendationsDrivenResponse,
+}
+
+
+def _unique(citations) -> List[str]:
+    return list(dict.fromkeys(citations))
+
+
+@lru_cache(maxsize=1024)
+def parse_response(
+    raw_message: str,
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+) -> Response:
+    """
+    Validate the JSON message from the AI against the response model of the
+    group. Responses are cached by message, and immutable so that they can be
+    shared.
+
+    :param raw_message: The JSON message from the AI.
+    :param group: The group the message was generated for.
+    :return: The parsed response.
+    :raises MalformedResponseError: If the message is not valid JSON, or does not
+        match the response model.
+    """
+    try:
+        return RESPONSE_MODELS[group].model_validate_json(raw_message)
+    except ValidationError as e:
+        raise MalformedResponseError(
+            f"The AI message does not match the {group.value} response: "
+            f"{e.error_count()} error(s)."
+        ) from e
+
+
+def check_hypotheses(response: Response, hypotheses: List[str]) -> None:
+    """
+    Check that a response evaluates exactly the hypotheses of the prompt, as
+    required by the hypothesis-driven JSON schema.
+
+    :param response: The parsed response.
+    :param hypotheses: The hypotheses used in the prompt.
+    :raises MalformedResponseError: If the hypotheses do not match.
+    """
+    if isinstance(response, HypothesisDrivenResponse) and set(
+        response.hypotheses
+    ) != set(hypotheses):
+        raise MalformedResponseError(
+            "The AI message does not evaluate the hypotheses of the prompt."
+        )
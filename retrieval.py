@@ -0,0 +1,171 @@
+"""
+This file contains the reduction of long case descriptions in the AI prompts.
+
+The whole case description is embedded in the prompts by default, so the
+number of prompt tokens, and the latency, grow with the length of the case.
+When `AI_CONTEXT_REDUCTION` is set, cases longer than
+`AI_CONTEXT_REDUCTION_MIN_WORDS` words are reduced to their opening, which
+presents the patient, and to the sentences most relevant to the hypotheses.
+Relevance is scored with BM25 over an index of the sentences of the case, built
+once per case. The passages are quoted verbatim, so that the citations of the AI
+can still be found in the case description, and their offsets are recorded in
+the AI help records so that the prompts can be rebuilt.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import streamlit as st
+
+from config import (
+    AI_CONTEXT_MAX_WORDS,
+    AI_CONTEXT_REDUCTION,
+    AI_CONTEXT_REDUCTION_MIN_WORDS,
+    AI_CONTEXT_SUMMARY_WORDS,
+)
+from hypotheses import get_synonyms, normalize_hypothesis
+from utils import get_case_description
+
+# Parameters of BM25: saturation of the term frequencies, and normalization by
+# the length of the sentences.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Marks the parts of the case left out of the prompt.
+OMISSION_MARK = "\n[...]\n"
+
+# A passage of the case description: its start and end offsets.
+Passage = Tuple[int, int]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    :return: The terms of a text, normalized like the hypotheses.
+    """
+    return normalize_hypothesis(text).split()
+
+
+class SentenceIndex:
+    """
+    BM25 index over the sentences of a case description.
+    """
+
+    def __init__(self, case_description: str):
+        # Sentences end with a punctuation mark or a paragraph break.
+        self.sentences: List[Passage] = [
+            (m.start(), m.end())
+            for m in re.finditer(
+                r"\S.*?(?:[.!?](?=\s)|(?=\n\s*\n)|$)", case_description, re.DOTALL
+            )
+        ]
+        self.lengths: List[int] = []
+        # Sentences containing each term, with the frequency of the term.
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for i, (start, end) in enumerate(self.sentences):
+            terms = Counter(tokenize(case_description[start:end]))
+            self.lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, []).append((i, frequency))
+        self.words = sum(self.lengths)
+        self.average_length = self.words / max(len(self.sentences), 1)
+
+    def score(self, terms: List[str]) -> Dict[int, float]:
+        """
+        :param terms: The terms of the query.
+        :return: The BM25 scores of the sentences containing any of the terms.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(terms):
+            postings = self.postings.get(term, [])
+            idf = math.log(
+                1 + (len(self.sentences) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for i, frequency in postings:
+                norm = 1 - BM25_B + BM25_B * self.lengths[i] / self.average_length
+                scores[i] = scores.get(i, 0) + idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * norm
+                )
+        return scores
+
+
+@st.cache_resource
+def get_sentence_index(case_index: int) -> SentenceIndex:
+    """
+    :param case_index: The index of the case.
+    :return: The sentence index of the case description, built once per case.
+    """
+    return SentenceIndex(get_case_description(case_index))
+
+
+def get_query_terms(hypotheses: List[str], case_index: int) -> List[str]:
+    """
+    :param hypotheses: The canonical hypotheses.
+    :param case_index: The index of the case.
+    :return: The terms of the hypotheses and of their other spellings.
+    """
+    hypotheses = [normalize_hypothesis(h) for h in hypotheses]
+    spellings = [s for s, c in get_synonyms(case_index).items() if c in hypotheses]
+    return [term for text in hypotheses + spellings for term in text.split()]
+
+
+def select_passages(case_index: int, hypotheses: List[str]) -> Tuple[Passage, ...]:
+    """
+    Select the opening of the case, then the sentences most relevant to the
+    hypotheses, within `AI_CONTEXT_MAX_WORDS` words.
+
+    :param case_index: The index of the case.
+    :param hypotheses: The canonical hypotheses.
+    :return: The passages, made of consecutive selected sentences, in order.
+    """
+    index = get_sentence_index(case_index)
+    selected = set()
+    words = 0
+    for i, length in enumerate(index.lengths):
+        if words >= AI_CONTEXT_SUMMARY_WORDS:
+            break
+        selected.add(i)
+        words += length
+
+    scores = index.score(get_query_terms(hypotheses, case_index))
+    for i in sorted(scores, key=lambda i: (-scores[i], i)):
+        if i not in selected and words + index.lengths[i] <= AI_CONTEXT_MAX_WORDS:
+            selected.add(i)
+            words += index.lengths[i]
+
+    passages: List[Passage] = []
+    for i in sorted(selected):
+        start, end = index.sentences[i]
+        if passages and i - 1 in selected:
+            passages[-1] = (passages[-1][0], end)
+        else:
+            passages.append((start, end))
+    return tuple(passages)
+
+
+def join_passages(case_description: str, passages: Tuple[Passage, ...]) -> str:
+    """
+    :return: The passages of the case description, with the parts left out
+        marked.
+    """
+    return OMISSION_MARK.join(case_description[start:end] for start, end in passages)
+
+
+def get_prompt_case_description(
+    case_index: int, hypotheses: List[str]
+) -> Tuple[str, Optional[Tuple[Passage, ...]]]:
+    """
+    :param case_index: The index of the case.
+    :param hypotheses: The canonical hypotheses of the prompt.
+    :return: The case description to embed in the prompt, and the passages it is
+        made of, or None if it is the whole case description.
+    """
+    case_description = get_case_description(case_index)
+    if (
+        not AI_CONTEXT_REDUCTION
+        or get_sentence_index(case_index).words < AI_CONTEXT_REDUCTION_MIN_WORDS
+    ):
+        return case_description, None
+    passages = select_passages(case_index, hypotheses)
+    return join_passages(case_description, passages), passages
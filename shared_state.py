@@ -0,0 +1,226 @@
+"""
+This file contains the state shared by the app workers of the multi-process
+deployment, see launcher.py.
+
+Each worker process has its own AI worker pool and Streamlit caches. So that
+the workers behave as one app, the completions, the rate limit budgets and the
+requests in flight are kept in a SQLite database that all of them open:
+- a completion received by a worker is served to the others from the database,
+- the token buckets of the rate limiter are read and updated in a transaction,
+- a request in flight in a worker is claimed, and the other workers wait for its
+  completion instead of sending it again.
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, Optional, Tuple
+
+from config import (
+    AI_SHARED_CACHE_SIZE,
+    AI_SINGLE_FLIGHT_POLL_SECONDS,
+    AI_SINGLE_FLIGHT_TIMEOUT_SECONDS,
+)
+from rate_limiter import RateLimiter
+
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import ChatCompletion
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    completion TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (model, prompt_hash)
+);
+CREATE INDEX IF NOT EXISTS completions_created_at ON completions (created_at);
+CREATE TABLE IF NOT EXISTS in_flight (
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (model, prompt_hash)
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    model TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (model, kind)
+);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    :param path: The path of the shared state database.
+    :return: A connection in autocommit mode, transactions are explicit.
+    """
+    return sqlite3.connect(path, timeout=30, isolation_level=None)
+
+
+@contextmanager
+def transaction(path: str) -> Iterator[sqlite3.Connection]:
+    """
+    Write transaction, holding the database lock from its start so that the
+    rows read in it cannot change before they are written.
+    """
+    with closing(connect(path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+class SharedCompletions:
+    """
+    Completions shared by the workers, with single-flight requests: a request is
+    only sent by the first worker asking for it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(connect(self.path)) as connection:
+            # Readers do not block the writer, nor the writer the readers.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def get(self, key: Tuple[str, str]) -> Optional["ChatCompletion"]:
+        """
+        :param key: The model and prompt hash of the request.
+        :return: The completion received by any worker, if any.
+        """
+        from openai.types.chat.chat_completion import ChatCompletion
+
+        with closing(connect(self.path)) as connection:
+            row = connection.execute(
+                "SELECT completion FROM completions WHERE model = ? AND prompt_hash = ?",
+                key,
+            ).fetchone()
+        return None if row is None else ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key: Tuple[str, str], completion: "ChatCompletion") -> None:
+        """
+        Store a completion, and release the claim on its request.
+        """
+        with transaction(self.path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (*key, completion.model_dump_json(), time.time()),
+            )
+            connection.execute(
+                "DELETE FROM in_flight WHERE model = ? AND prompt_hash = ?", key
+            )
+            connection.execute(
+                "DELETE FROM completions WHERE rowid NOT IN (SELECT rowid FROM "
+                "completions ORDER BY created_at DESC LIMIT ?)",
+                (AI_SHARED_CACHE_SIZE,),
+            )
+
+    def delete(self, key: Tuple[str, str]) -> None:
+        """
+        Remove a completion, so that its request is sent again.
+        """
+        with transaction(self.path) as connection:
+            connection.execute(
+                "DELETE FROM completions WHERE model = ? AND prompt_hash = ?", key
+            )
+
+    def claim(self, key: Tuple[str, str]) -> bool:
+        """
+        :param key: The model and prompt hash of the request.
+        :return: Whether this worker is the one to send the request. Claims older
+            than `AI_SINGLE_FLIGHT_TIMEOUT_SECONDS` are assumed to be lost.
+        """
+        now = time.time()
+        with transaction(self.path) as connection:
+            connection.execute(
+                "DELETE FROM in_flight WHERE claimed_at < ?",
+                (now - AI_SINGLE_FLIGHT_TIMEOUT_SECONDS,),
+            )
+            return (
+                connection.execute(
+                    "INSERT OR IGNORE INTO in_flight VALUES (?, ?, ?, ?)",
+                    (*key, os.getpid(), now),
+                ).rowcount
+                == 1
+            )
+
+    def release(self, key: Tuple[str, str]) -> None:
+        """
+        Give up the claim on a request, so that another worker can send it.
+        """
+        with transaction(self.path) as connection:
+            connection.execute(
+                "DELETE FROM in_flight WHERE model = ? AND prompt_hash = ? AND pid = ?",
+                (*key, os.getpid()),
+            )
+
+    def get_or_create(
+        self, key: Tuple[str, str], create: Callable[[], "ChatCompletion"]
+    ) -> Tuple["ChatCompletion", bool]:
+        """
+        Get the completion of a request, sending it only if no worker received
+        or is waiting for it.
+
+        :param key: The model and prompt hash of the request.
+        :param create: The function sending the request.
+        :return: The completion, and whether it was sent by this worker.
+        """
+        while True:
+            completion = self.get(key)
+            if completion is not None:
+                return completion, False
+            if self.claim(key):
+                try:
+                    completion = create()
+                except BaseException:
+                    self.release(key)
+                    raise
+                self.put(key, completion)
+                return completion, True
+            time.sleep(AI_SINGLE_FLIGHT_POLL_SECONDS)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    Rate limiter whose budgets are shared by the workers. The buckets are loaded
+    from the database and written back around each read and update.
+    """
+
+    def __init__(self, path: str, rate_limits: Dict[str, Dict[str, int]]):
+        super().__init__(rate_limits)
+        self.path = path
+        with closing(connect(self.path)) as connection:
+            connection.executescript(SCHEMA)
+        self._buckets = {"requests": self._requests, "tokens": self._tokens}
+
+    @contextmanager
+    def _synchronized(self) -> Iterator[None]:
+        # The lock serializes the threads of this worker, the database
+        # transaction the other workers.
+        with self._lock, transaction(self.path) as connection:
+            # The buckets use the monotonic clock, which restarts with the
+            # machine while the database persists, so their times are stored
+            # from the wall clock.
+            offset = time.time() - time.monotonic()
+            for model, kind, level, updated_at in connection.execute(
+                "SELECT model, kind, level, updated_at FROM buckets"
+            ):
+                if model in self._buckets[kind]:
+                    self._buckets[kind][model].level = level
+                    self._buckets[kind][model].updated_at = updated_at - offset
+            yield
+            connection.executemany(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                [
+                    (model, kind, bucket.level, bucket.updated_at + offset)
+                    for kind, buckets in self._buckets.items()
+                    for model, bucket in buckets.items()
+                ],
+            )
@@ -0,0 +1,163 @@
+"""
+This file contains the token counting used to check that AI requests fit the
+context window of the selected model, and to budget the rate limits.
+
+Counts are cached: each case description is only tokenized once per model, and
+the prompt and schema costs of a request are built from cached per-hypothesis
+counts, so adding a hypothesis does not re-tokenize the whole prompt. Replayed
+sessions, whose requests are seldom sent, estimate the tokens from the length of
+the request instead of loading the tokenizer.
+"""
+
+import json
+import math
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Literal
+
+from config import AI_EXPECTED_OUTPUT_TOKENS, OPENAI_CONTEXT_WINDOWS, Group
+
+# Tokens added by the chat format for the system and user messages.
+MESSAGES_OVERHEAD_TOKENS = 12
+
+# Characters per token assumed when estimating without a tokenizer, fewer than
+# in English text so that the estimate is on the high side.
+ESTIMATED_CHARACTERS_PER_TOKEN = 3
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+class PromptTooLongError(ValueError):
+    """
+    Raised when a request does not fit the context window of the model.
+    """
+
+    def __init__(self, model: str, tokens: int):
+        super().__init__(
+            f"The request needs {tokens} tokens, more than the "
+            f"{OPENAI_CONTEXT_WINDOWS[model]} tokens of {model}."
+        )
+        self.model = model
+        self.tokens = tokens
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> "tiktoken.Encoding":
+    """
+    :param model: The model to get the tokenizer of.
+    :return: The tokenizer of the model.
+    """
+    # Imported on first use, the tokenizers are only needed once the experiment
+    # starts.
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(model: str, text: str) -> int:
+    """
+    :param model: The model whose tokenizer to use.
+    :param text: The text to tokenize.
+    :return: The number of tokens of the text.
+    """
+    return len(get_encoding(model).encode(text))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    :param text: The text to estimate the number of tokens of.
+    :return: An estimate of the number of tokens of the text from its length,
+        without loading a tokenizer.
+    """
+    return math.ceil(len(text) / ESTIMATED_CHARACTERS_PER_TOKEN)
+
+
+@lru_cache(maxsize=None)
+def _count_fixed_tokens(
+    model: str,
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+) -> int:
+    """
+    :return: The number of tokens of the prompt and schema without the case
+        description and hypotheses.
+    """
+    # Imported here to avoid a circular import, as utils imports this module.
+    from utils import get_ai_prompt, get_json_schema
+
+    return (
+        MESSAGES_OVERHEAD_TOKENS
+        + count_tokens(model, get_ai_prompt(group, "", []))
+        + count_tokens(model, json.dumps(get_json_schema(group, [])))
+    )
+
+
+@lru_cache(maxsize=None)
+def _count_tokens_per_option(
+    model: str,
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+) -> int:
+    """
+    :return: The number of tokens the schema grows by for each hypothesis, not
+        counting the hypothesis itself.
+    """
+    from utils import get_json_schema
+
+    return (
+        count_tokens(model, json.dumps(get_json_schema(group, ["x"])))
+        - count_tokens(model, json.dumps(get_json_schema(group, [])))
+        - 2 * count_tokens(model, "x")
+    )
+
+
+def count_request_tokens(
+    model: str,
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+    case_description: str,
+    hypotheses: List[str],
+    estimate: bool = False,
+) -> int:
+    """
+    Count the tokens of an AI request, including the expected response.
+
+    :param model: The model the request is sent to.
+    :param group: The group of the user.
+    :param case_description: The case description used in the prompt.
+    :param hypotheses: The hypotheses used in the prompt.
+    :param estimate: Whether to estimate the tokens of the prompt and schema from
+        their length rather than with the tokenizer of the model.
+    :return: The number of tokens of the request.
+    :raises PromptTooLongError: If the request does not fit the context window.
+    """
+    if estimate:
+        from utils import get_ai_prompt, get_json_schema
+
+        tokens = (
+            MESSAGES_OVERHEAD_TOKENS
+            + estimate_tokens(get_ai_prompt(group, case_description, hypotheses))
+            + estimate_tokens(json.dumps(get_json_schema(group, hypotheses)))
+        )
+    else:
+        tokens = _count_fixed_tokens(model, group)
+        tokens += count_tokens(model, case_description)
+        for hypothesis in hypotheses:
+            # Hypotheses are separated by a newline in the prompt.
+            tokens += count_tokens(model, hypothesis) + 1
+        if group is Group.HYPOTHESIS_DRIVEN:
+            # Each hypothesis is both a property name and a required key.
+            tokens += sum(
+                _count_tokens_per_option(model, group) + 2 * count_tokens(model, h)
+                for h in hypotheses
+            )
+
+    output_tokens = AI_EXPECTED_OUTPUT_TOKENS[group]
+    if group is Group.HYPOTHESIS_DRIVEN:
+        output_tokens *= len(hypotheses)
+
+    tokens += output_tokens
+    if tokens > OPENAI_CONTEXT_WINDOWS.get(model, tokens):
+        raise PromptTooLongError(model, tokens)
+    return tokens
@@ -0,0 +1,299 @@
+"""
+This file contains the compressed store of the AI transcripts of the results.
+
+The prompts and raw AI messages are highly repetitive across sessions (same
+keys, same case quotes), so they are kept out of the results files and stored
+in a SQLite database, compressed with zstd and a dictionary trained on the
+stored transcripts. Transcripts are indexed by session and case, and put back
+into the results by `load_results`, so that the analysis does not see the
+difference.
+
+Training a dictionary recompresses all the transcripts, so it is left out of
+the sessions: `compress` trains the first one once enough transcripts are
+stored, and `train` a new one.
+
+Usage:
+    python transcripts.py compress  # Move the messages of the results files.
+    python transcripts.py train     # Train a new dictionary.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import zstandard
+
+from config import (
+    TRANSCRIPTS_COMPRESSION_LEVEL,
+    TRANSCRIPTS_DB_PATH,
+    TRANSCRIPTS_DICTIONARY_SIZE,
+    TRANSCRIPTS_MIN_TRAINING_SAMPLES,
+)
+from records import AI_HELP_KEY_PATTERN
+
+# Entries of the AI help records that are stored as transcripts.
+MESSAGE_KINDS = ["raw_message", "draft_raw_message"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dictionaries (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transcripts (
+    session TEXT NOT NULL,
+    case_index INTEGER NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    dictionary_id INTEGER REFERENCES dictionaries (id),
+    data BLOB NOT NULL,
+    PRIMARY KEY (session, case_index, prompt_hash, kind)
+);
+"""
+
+# A transcript: the session, case index, prompt hash, kind and text.
+Transcript = Tuple[str, int, str, str, str]
+
+
+class TranscriptStore:
+    """
+    Compressed transcripts, by session, case, prompt hash and kind ("prompt",
+    "raw_message" or "draft_raw_message").
+    """
+
+    def __init__(self, path: str = TRANSCRIPTS_DB_PATH):
+        self.path = path
+        self._compressors: Dict[Optional[int], zstandard.ZstdCompressor] = {}
+        self._decompressors: Dict[Optional[int], zstandard.ZstdDecompressor] = {}
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get_dictionary(
+        self, connection: sqlite3.Connection, dictionary_id: Optional[int]
+    ) -> Optional[zstandard.ZstdCompressionDict]:
+        if dictionary_id is None:
+            return None
+        (data,) = connection.execute(
+            "SELECT data FROM dictionaries WHERE id = ?", (dictionary_id,)
+        ).fetchone()
+        return zstandard.ZstdCompressionDict(data)
+
+    def _compress(
+        self, connection: sqlite3.Connection, dictionary_id: Optional[int], text: str
+    ) -> bytes:
+        if dictionary_id not in self._compressors:
+            self._compressors[dictionary_id] = zstandard.ZstdCompressor(
+                level=TRANSCRIPTS_COMPRESSION_LEVEL,
+                dict_data=self._get_dictionary(connection, dictionary_id),
+            )
+        return self._compressors[dictionary_id].compress(text.encode("utf-8"))
+
+    def _decompress(
+        self, connection: sqlite3.Connection, dictionary_id: Optional[int], data: bytes
+    ) -> str:
+        if dictionary_id not in self._decompressors:
+            self._decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                dict_data=self._get_dictionary(connection, dictionary_id)
+            )
+        return self._decompressors[dictionary_id].decompress(data).decode("utf-8")
+
+    @staticmethod
+    def _latest_dictionary_id(connection: sqlite3.Connection) -> Optional[int]:
+        return connection.execute("SELECT MAX(id) FROM dictionaries").fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+
+    def put(self, transcripts: Iterable[Transcript]) -> None:
+        """
+        Store transcripts, compressed with the latest dictionary.
+
+        :param transcripts: The transcripts to store.
+        """
+        with self._connect() as connection:
+            dictionary_id = self._latest_dictionary_id(connection)
+            connection.executemany(
+                "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        session,
+                        case_index,
+                        prompt_hash,
+                        kind,
+                        dictionary_id,
+                        self._compress(connection, dictionary_id, text),
+                    )
+                    for session, case_index, prompt_hash, kind, text in transcripts
+                ],
+            )
+
+    def needs_dictionary(self) -> bool:
+        """
+        :return: Whether no dictionary was trained yet and enough transcripts are
+            stored to train the first one.
+        """
+        with self._connect() as connection:
+            if self._latest_dictionary_id(connection) is not None:
+                return False
+        return len(self) >= TRANSCRIPTS_MIN_TRAINING_SAMPLES
+
+    def get(self, session: str, case_index: int) -> Dict[Tuple[str, str], str]:
+        """
+        :param session: The session, i.e. the name of its results file.
+        :param case_index: The index of the case.
+        :return: The transcripts of the case, by prompt hash and kind.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT prompt_hash, kind, dictionary_id, data FROM transcripts "
+                "WHERE session = ? AND case_index = ?",
+                (session, case_index),
+            ).fetchall()
+            return {
+                (prompt_hash, kind): self._decompress(connection, dictionary_id, data)
+                for prompt_hash, kind, dictionary_id, data in rows
+            }
+
+    def train_dictionary(self) -> int:
+        """
+        Train a dictionary on the stored transcripts, and recompress them with it.
+
+        :return: The id of the new dictionary.
+        :raises zstandard.ZstdError: If there are too few transcripts to train a
+            dictionary on.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT rowid, dictionary_id, data FROM transcripts"
+            ).fetchall()
+            texts = {
+                rowid: self._decompress(connection, dictionary_id, data)
+                for rowid, dictionary_id, data in rows
+            }
+            dictionary = zstandard.train_dictionary(
+                TRANSCRIPTS_DICTIONARY_SIZE,
+                [text.encode("utf-8") for text in texts.values()],
+                level=TRANSCRIPTS_COMPRESSION_LEVEL,
+            )
+            dictionary_id = connection.execute(
+                "INSERT INTO dictionaries (data) VALUES (?)",
+                (dictionary.as_bytes(),),
+            ).lastrowid
+            connection.executemany(
+                "UPDATE transcripts SET dictionary_id = ?, data = ? WHERE rowid = ?",
+                [
+                    (dictionary_id, self._compress(connection, dictionary_id, text), r)
+                    for r, text in texts.items()
+                ],
+            )
+        # Give back the pages freed by the recompression.
+        self._connect().execute("VACUUM")
+        return dictionary_id
+
+
+def extract_transcripts(session: str, results: Dict[str, Any]) -> Iterable[Transcript]:
+    """
+    Take the messages out of the AI help records of the results of a session.
+
+    :param session: The session, i.e. the name of its results file.
+    :param results: The results of the session, which are modified.
+    :return: The transcripts of the messages.
+    """
+    for key, entry in results.items():
+        match = AI_HELP_KEY_PATTERN.fullmatch(key)
+        # Records saved before the prompt hash was recorded are left as is.
+        if match is None or entry.get("prompt_hash") is None:
+            continue
+        for kind in MESSAGE_KINDS:
+            if entry.get(kind) is not None:
+                yield (
+                    session,
+                    int(match.group(1)),
+                    entry["prompt_hash"],
+                    kind,
+                    entry[kind],
+                )
+                entry[kind] = None
+
+
+def load_results(
+    folder_path: str = "results", store: Optional[TranscriptStore] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Load the results files of a folder, with the messages of their AI help
+    records put back from the transcript store.
+
+    :param folder_path: The folder containing the results files.
+    :param store: The transcript store, by default the one of the folder.
+    :return: The results of each session, by session.
+    """
+    if store is None:
+        store = TranscriptStore(os.path.join(folder_path, "transcripts.db"))
+
+    sessions = {}
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith(".json"):
+            continue
+        session = filename.removesuffix(".json")
+        with open(os.path.join(folder_path, filename), "r") as json_file:
+            results = json.load(json_file)
+
+        case_transcripts: Dict[int, Dict[Tuple[str, str], str]] = {}
+        for key, entry in results.items():
+            match = AI_HELP_KEY_PATTERN.fullmatch(key)
+            if match is None or entry.get("prompt_hash") is None:
+                continue
+            case_index = int(match.group(1))
+            if case_index not in case_transcripts:
+                case_transcripts[case_index] = store.get(session, case_index)
+            for kind in MESSAGE_KINDS:
+                if entry.get(kind) is None:
+                    entry[kind] = case_transcripts[case_index].get(
+                        (entry["prompt_hash"], kind)
+                    )
+        sessions[session] = results
+    return sessions
+
+
+def train_dictionary(store: TranscriptStore) -> None:
+    try:
+        print(f"Trained dictionary {store.train_dictionary()}.")
+    except zstandard.ZstdError as e:
+        print(f"No dictionary trained, {len(store)} transcripts stored: {e}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["compress", "train"])
+    parser.add_argument("--results", default="results", help="Results folder.")
+    args = parser.parse_args()
+
+    store = TranscriptStore(os.path.join(args.results, "transcripts.db"))
+    if args.command == "train":
+        train_dictionary(store)
+        return
+
+    for filename in sorted(os.listdir(args.results)):
+        if not filename.endswith(".json"):
+            continue
+        file_path = os.path.join(args.results, filename)
+        with open(file_path, "r") as json_file:
+            results = json.load(json_file)
+        transcripts = list(extract_transcripts(filename.removesuffix(".json"), results))
+        if len(transcripts) == 0:
+            continue
+        store.put(transcripts)
+        with open(file_path, "w") as json_file:
+            json.dump(results, json_file, default=str)
+        print(f"{filename}: {len(transcripts)} messages moved.")
+    if store.needs_dictionary():
+        train_dictionary(store)
+
+
+if __name__ == "__main__":
+    main()
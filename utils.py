@@ -2,15 +2,37 @@
 This file contains utility functions that are used across the app.
 """
 
+import hashlib
 import json
 import re
 import string
-from typing import Any, Dict, List, Literal, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional, Tuple
 
 import streamlit as st
-from openai.types.chat.chat_completion import ChatCompletion
 
-from config import Group
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from ai_jobs import AIJob, AIWorkerPool, Priority
+from config import (
+    AI_MAX_CONCURRENT_REQUESTS,
+    APP_WORKERS,
+    OPENAI_RATE_LIMITS,
+    SHARED_STATE_DB_PATH,
+    Backend,
+    Group,
+)
+from events import EventKind, EventLog
+from progress import SessionsTable, StudyProgress
+from rate_limiter import RateLimiter
+from shared_state import SharedCompletions, SharedRateLimiter
+from tokens import count_request_tokens
+
+# The OpenAI package takes most of the import time of the app, it is only
+# imported once the AI is called. Likewise, the response models (and pydantic)
+# are imported by the functions parsing the AI messages.
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.types.chat.chat_completion import ChatCompletion
 
 
 def page_setup(page_title: str) -> None:
@@ -24,6 +46,14 @@ def page_setup(page_title: str) -> None:
         page_title=page_title, layout="wide", initial_sidebar_state="collapsed"
     )
 
+    # Pages are rerun on every interaction, only log when one is entered. Pages
+    # are told apart by their script, as some share a title.
+    ctx = get_script_run_ctx()
+    page = ctx.page_script_hash if ctx is not None else page_title
+    if st.session_state.get("page_script") != page:
+        st.session_state["page_script"] = page
+        log_event(EventKind.PAGE_LOAD, page=page_title)
+
 
 def save_widget(key: str, new_name: Optional[str] = None) -> None:
     """
@@ -61,30 +91,57 @@ def get_case_description(case_index: int) -> str:
     return open(f"data/case_{case_index}.txt", "r").read()
 
 
-def parse_case_description(case_description: str, citations: list[str] | None) -> str:
+def is_citation_grounded(citation: str, case_description: str) -> bool:
+    """
+    :param citation: A citation from the AI message.
+    :param case_description: The case description.
+    :return: Whether the citation can be found in the case description, ignoring
+        case and surrounding punctuation, as highlighted by the case viewer.
     """
-    Parse the case description by adding citations to the text.
+    return citation.strip(string.punctuation).lower() in case_description.lower()
 
+
+def evaluate_message(
+    raw_message: str | None,
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+    case_description: str,
+    hypotheses: List[str],
+) -> Dict[str, Any]:
+    """
+    :param raw_message: The JSON message from the AI.
+    :param group: The group the message was generated for.
     :param case_description: The case description.
-    :param citations: The list of citations.
-    :return: The parsed case description.
-    """
-    if citations is None:
-        return case_description
-
-    for citation in citations:
-        citation_stripped_of_punctuation = citation.strip(string.punctuation)
-
-        # Use re.sub for case-insensitive replacement
-        case_description = re.sub(
-            re.escape(citation_stripped_of_punctuation),
-            f":red-background[{citation_stripped_of_punctuation} \
-                [{citations.index(citation) + 1}]]",
-            case_description,
-            flags=re.IGNORECASE,
-        )
+    :param hypotheses: The hypotheses used in the prompt.
+    :return: Whether the message is valid, and the number of grounded citations.
+    """
+    evaluation = {
+        "schema_valid": False,
+        "citations": 0,
+        "grounded_citations": 0,
+        "lead_diagnosis_valid": None,
+    }
+    from responses import (
+        MalformedResponseError,
+        RecommendationsDrivenResponse,
+        check_hypotheses,
+        parse_response,
+    )
+
+    try:
+        response = parse_response(raw_message or "", group)
+        check_hypotheses(response, hypotheses)
+    except MalformedResponseError:
+        return evaluation
+    evaluation["schema_valid"] = True
 
-    return case_description
+    if isinstance(response, RecommendationsDrivenResponse):
+        evaluation["lead_diagnosis_valid"] = response.lead_diagnosis in hypotheses
+
+    evaluation["citations"] = len(response.citations)
+    evaluation["grounded_citations"] = sum(
+        is_citation_grounded(c, case_description) for c in response.citations
+    )
+    return evaluation
 
 
 def get_group() -> Group:
@@ -113,59 +170,72 @@ def get_hypotheses(hypotheses_table: dict) -> Tuple[List[str], List[str]]:
 
 @st.cache_data
 def parse_message(
-    message: str, hypotheses: List[str], selected_hypotheses: List[str], group: Group
+    message: str,
+    selected_hypotheses: List[str],
+    group: Group,
+    original_spellings: Optional[Dict[str, str]] = None,
 ) -> Tuple[List[str], str]:
     """
     Parse the JSON message from the AI, notably by adding citations to the
     text.
 
-    :param message: The JSON message from the AI.
-    :param hypotheses: The hypotheses used in the AI prompt.
+    :param message: The JSON message from the AI, already validated with
+        `parse_response`.
+    :param selected_hypotheses: The hypotheses to show the evidence of, for the
+        hypothesis-driven group.
     :param group: The group of the user.
+    :param original_spellings: The spellings of the user to display instead of
+        the canonical hypotheses, if any.
     :return: A tuple containing the list of citations and the parsed message.
     """
+    from responses import (
+        HypothesisDrivenResponse,
+        RecommendationsDrivenResponse,
+        parse_response,
+    )
+
+    if original_spellings is None:
+        original_spellings = {}
 
-    message_dict = json.loads(message)
+    response = parse_response(message, group)
 
     parsed_message = ""
     citations = []
 
-    if group is Group.HYPOTHESIS_DRIVEN:
-        message_dict = message_dict[selected_hypotheses[0]]
-        parsed_message += f"**Evidence for {selected_hypotheses[0]}**\n\n"
-        for e in message_dict["evidence_for"]:
-            parsed_message += f"- {e['claim']}"
-            for c in e["citations"]:
-                if c not in citations:
-                    citations.append(c)
-                parsed_message += f" :red-background[[{citations.index(c) + 1}]]"
-            parsed_message += "\n\n"
-
-        parsed_message += f"**Evidence against {selected_hypotheses[0]}**\n\n"
-        for e in message_dict["evidence_against"]:
-            parsed_message += f"- {e['claim']}"
-            for c in e["citations"]:
-                if c not in citations:
-                    citations.append(c)
-                parsed_message += f" :red-background[[{citations.index(c) + 1}]]"
-            parsed_message += "\n\n"
-
-    if group is Group.RECOMMENDATIONS_DRIVEN:
+    if isinstance(response, HypothesisDrivenResponse):
+        evaluation = response[selected_hypotheses[0]]
+        hypothesis = original_spellings.get(
+            selected_hypotheses[0], selected_hypotheses[0]
+        )
+        citations = evaluation.citations
+        for label, evidence in [
+            ("Evidence for", evaluation.evidence_for),
+            ("Evidence against", evaluation.evidence_against),
+        ]:
+            parsed_message += f"**{label} {hypothesis}**\n\n"
+            for e in evidence:
+                parsed_message += f"- {e.claim}"
+                for c in e.citations:
+                    parsed_message += f" :red-background[[{citations.index(c) + 1}]]"
+                parsed_message += "\n\n"
+
+    if isinstance(response, RecommendationsDrivenResponse):
+        lead_diagnosis = original_spellings.get(
+            response.lead_diagnosis, response.lead_diagnosis
+        )
         parsed_message += f"Recommended lead diagnosis: \
-            **{message_dict['lead_diagnosis']}**\n\n"
+            **{lead_diagnosis}**\n\n"
 
         parsed_rationale = re.sub(
             r"\[(\d+)\]",
             lambda x: f":red-background[[{x.group(1)}]]",
-            message_dict["rationale"],
+            response.rationale,
         )
 
         parsed_message += f"**Rationale:** \
             {parsed_rationale}\n\n"
 
-        for c in message_dict["citations"]:
-            if c not in citations:
-                citations.append(c)
+        citations = list(dict.fromkeys(response.citations))
 
     return citations, parsed_message
 
@@ -175,7 +245,11 @@ def parse_message(
 #######################################
 
 
-def get_client():
+def get_client() -> "OpenAI":
+    if "client" not in st.session_state:
+        from openai import OpenAI
+
+        st.session_state["client"] = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
     return st.session_state["client"]
 
 
@@ -183,26 +257,186 @@ def get_model():
     return st.session_state["results"]["model"]
 
 
-@st.cache_data(show_spinner=False)
-def get_chat_completion(prompt: str, json_schema: Dict[str, Any]) -> ChatCompletion:
+def get_backend() -> Backend:
+    return st.session_state["results"].get("backend", Backend.OPENAI)
+
+
+def get_cascade() -> bool:
+    return st.session_state["results"].get("cascade", False)
+
+
+def get_prompt_hash(prompt: str, json_schema: Dict[str, Any]) -> str:
     """
     :param prompt: The prompt to send to the AI.
     :param json_schema: The JSON schema to use for the response.
-    :return: The chat completion object from OpenAI.
+    :return: A hash identifying the request, used to share identical requests.
+    """
+    return hashlib.sha256(
+        (prompt + json.dumps(json_schema, sort_keys=True)).encode("utf-8")
+    ).hexdigest()
+
+
+@st.cache_resource
+def get_ai_worker_pool() -> AIWorkerPool:
+    """
+    :return: The worker pool, shared by all sessions, running the AI calls. In
+        the multi-process deployment, the concurrent requests are split between
+        the app workers, and the rate limits and completions are shared.
+    """
+    max_workers = max(1, AI_MAX_CONCURRENT_REQUESTS // APP_WORKERS)
+    if SHARED_STATE_DB_PATH is None:
+        return AIWorkerPool(
+            max_workers=max_workers, rate_limiter=RateLimiter(OPENAI_RATE_LIMITS)
+        )
+    return AIWorkerPool(
+        max_workers=max_workers,
+        rate_limiter=SharedRateLimiter(SHARED_STATE_DB_PATH, OPENAI_RATE_LIMITS),
+        shared_completions=SharedCompletions(SHARED_STATE_DB_PATH),
+    )
+
+
+@st.cache_resource
+def get_replay_store():
+    """
+    :return: The completions recorded in the results folder, loaded once.
+    """
+    # Imported here to avoid a circular import, as replay imports this module.
+    from replay import ReplayStore
+
+    return ReplayStore.from_results("results")
+
+
+def get_session_id() -> str:
+    ctx = get_script_run_ctx()
+    assert ctx is not None, "No Streamlit session is running"
+    return ctx.session_id
+
+
+@st.cache_resource
+def get_event_log() -> EventLog:
+    """
+    :return: The event log, shared by all sessions.
+    """
+    return EventLog()
+
+
+@st.cache_resource
+def get_study_progress() -> StudyProgress:
+    """
+    :return: The running statistics of the completed sessions, shared by all
+        the dashboard viewers.
+    """
+    return StudyProgress(SessionsTable())
+
+
+def log_event(kind: EventKind, **data: Any) -> None:
+    """
+    Record an event of the current session, in the current case if any.
+
+    :param kind: The kind of event.
+    :param data: Details of the event.
+    """
+    get_event_log().record(
+        get_session_id(), kind, st.session_state.get("case_index"), **data
+    )
+
+
+def get_ai_request(
+    group: Literal[Group.HYPOTHESIS_DRIVEN, Group.RECOMMENDATIONS_DRIVEN],
+    case_description: str,
+    hypotheses: List[str],
+) -> Tuple[str, Dict[str, Any], int]:
     """
-    completion = get_client().chat.completions.create(
-        model=get_model(),
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt},
-        ],
-        response_format={"type": "json_schema", "json_schema": json_schema},
-        temperature=0,
+    Build an AI request and check that it fits the context window of the model.
+
+    :param group: The group of the user.
+    :param case_description: The case description.
+    :param hypotheses: The hypotheses of the user.
+    :return: A tuple containing the prompt, the JSON schema and the number of
+        tokens of the request.
+    :raises PromptTooLongError: If the request does not fit the context window.
+    """
+    # The tokenizer is not loaded for replayed sessions, whose requests are
+    # seldom sent, their tokens are estimated instead.
+    tokens = count_request_tokens(
+        get_model(),
+        group,
+        case_description,
+        hypotheses,
+        estimate=get_backend() is not Backend.OPENAI,
+    )
+    return (
+        get_ai_prompt(group, case_description, hypotheses),
+        get_json_schema(group, hypotheses),
+        tokens,
+    )
+
+
+def submit_chat_completion(
+    prompt: str,
+    json_schema: Dict[str, Any],
+    tokens: int,
+    priority: Priority = Priority.LIVE,
+    model: Optional[str] = None,
+) -> AIJob:
+    """
+    Queue the prompt in the worker pool without waiting for the answer.
+
+    :param prompt: The prompt to send to the AI.
+    :param json_schema: The JSON schema to use for the response.
+    :param tokens: The number of tokens of the request, as given by
+        `get_ai_request`.
+    :param priority: The priority of the request.
+    :param model: The model to use, if not the one selected for the experiment.
+    :return: The job handle, whose result is the chat completion object from OpenAI.
+    """
+    from replay import ReplayMissError
+
+    prompt_hash = get_prompt_hash(prompt, json_schema)
+    model = model or get_model()
+
+    if get_backend() is not Backend.OPENAI:
+        key = (model, prompt_hash)
+        strict = get_backend() is Backend.REPLAY_STRICT
+        try:
+            # Only the model asked for is replayed in strict mode.
+            completion = get_replay_store().get_chat_completion(
+                prompt_hash, model, other_models=not strict
+            )
+        except ReplayMissError as e:
+            if strict:
+                return AIJob.from_result(key, model, prompt, json_schema, error=e)
+        else:
+            # The job is attributed to the model the message was recorded with.
+            return AIJob.from_result(
+                key, completion.model, prompt, json_schema, completion=completion
+            )
+
+    return get_ai_worker_pool().submit(
+        get_client(),
+        model,
+        prompt,
+        json_schema,
+        prompt_hash,
+        tokens,
+        get_session_id(),
+        priority,
     )
-    return completion
 
 
-def get_latest_message_content(completion: ChatCompletion) -> str | None:
+def get_chat_completion(
+    prompt: str, json_schema: Dict[str, Any], tokens: int
+) -> "ChatCompletion":
+    """
+    :param prompt: The prompt to send to the AI.
+    :param json_schema: The JSON schema to use for the response.
+    :param tokens: The number of tokens of the request.
+    :return: The chat completion object from OpenAI.
+    """
+    return submit_chat_completion(prompt, json_schema, tokens).result()
+
+
+def get_latest_message_content(completion: "ChatCompletion") -> str | None:
     """
     :param completion: The chat completion object from OpenAI.
     :return: String of the latest message in the thread.